@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+#
+# Copyright © 2012-2018 Umang Varma <umang.me@gmail.com>
+#
+# This file is part of indicator-stickynotes.
+#
+# indicator-stickynotes is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# indicator-stickynotes is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# indicator-stickynotes.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Times building the window of a note
+
+"file" builds it the way every note used to: a new Gtk.Builder, registering
+GtkSource.View and parsing StickyNotes.ui from disk. "string" parses the
+definition cached in memory, and "resource" (if the bundle has been built
+with setup.py build_resources) the one in the resource bundle. "note"
+creates complete StickyNote windows for notes of a NoteSet. Needs a
+display."""
+
+import argparse
+import os.path
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    ".."))
+from stickynotes import gui
+from stickynotes.backend import NoteSet
+from stickynotes.gui import Gtk, GObject, GtkSource
+from stickynotes.info import RESOURCE_PREFIX
+
+class Indicator:
+    """Stands in for IndicatorStickyNotes, which windows only call back"""
+    def show_settings(self, *args):
+        pass
+
+def build_from_file():
+    builder = Gtk.Builder()
+    GObject.type_register(GtkSource.View)
+    builder.add_from_file(gui.asset_path("StickyNotes.ui"))
+    return builder
+
+def build_from_string():
+    builder = Gtk.Builder()
+    builder.add_from_string(gui.ui_definition("StickyNotes.ui"))
+    return builder
+
+def build_from_resource():
+    builder = Gtk.Builder()
+    builder.add_from_resource(RESOURCE_PREFIX + "StickyNotes.ui")
+    return builder
+
+def time_builder(build, count):
+    """Returns the mean time in seconds of building a note window"""
+    start = time.perf_counter()
+    for i in range(count):
+        build().get_object("MainWindow").destroy()
+    return (time.perf_counter() - start) / count
+
+def time_notes(count):
+    """Returns the mean time in seconds of creating a StickyNote"""
+    with tempfile.TemporaryDirectory() as directory:
+        nset = NoteSet(gui.StickyNote, os.path.join(directory, "notes"),
+                Indicator())
+        nset.loads("{}")
+        start = time.perf_counter()
+        for i in range(count):
+            nset.new()
+        elapsed = time.perf_counter() - start
+        for note in nset.notes:
+            note.gui.winMain.destroy()
+    return elapsed / count
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--count", type=int, default=100,
+            help="windows to build for each method")
+    args = parser.parse_args()
+    if not Gtk.init_check(sys.argv)[0]:
+        sys.exit("Cannot open a display")
+    methods = [("file", build_from_file), ("string", build_from_string)]
+    if gui.have_resources:
+        methods.append(("resource", build_from_resource))
+    # Warm up, so that the first method does not pay for loading themes
+    time_builder(build_from_string, 1)
+    for name, build in methods:
+        print("{0:8} {1:6.2f} ms per window".format(name,
+            1000 * time_builder(build, args.count)))
+    print("{0:8} {1:6.2f} ms per window".format("note",
+        1000 * time_notes(args.count)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+#
+# Copyright © 2012-2018 Umang Varma <umang.me@gmail.com>
+#
+# This file is part of indicator-stickynotes.
+#
+# indicator-stickynotes is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# indicator-stickynotes is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# indicator-stickynotes.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures the memory taken by loaded notes
+
+Every source tree given (by default, the one containing this script) is
+measured in a separate process, so the Note class of this tree can be
+compared with an older one, e.g. a checkout made with
+"git worktree add /tmp/old <commit>"."""
+
+import argparse
+import gc
+import json
+import os.path
+import subprocess
+import sys
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def export_data(count):
+    """Returns a data file of count notes with typical properties"""
+    return json.dumps({"notes": [{"uuid": "note-{0}".format(i), "body": "",
+        "last_modified": "2018-01-01T00:00:00",
+        "properties": {"position": [10, 10], "size": [200, 150],
+            "locked": False}, "cat": ""} for i in range(count)],
+        "properties": {}, "categories": {}})
+
+def measure(count):
+    """Returns the bytes allocated per note by NoteSet.loads()"""
+    from stickynotes.backend import NoteSet
+    data = export_data(count)
+    nset = NoteSet(lambda note: None, os.path.join(HERE, "unused"), None)
+    gc.collect()
+    tracemalloc.start()
+    nset.loads(data)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size / count
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("trees", nargs="*",
+            default=[os.path.join(HERE, "..")], help="source trees to "
+            "measure")
+    parser.add_argument("--count", type=int, default=50000,
+            help="number of notes")
+    parser.add_argument("--measure", action="store_true",
+            help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        sys.path.insert(0, args.trees[0])
+        print(measure(args.count))
+        return
+    for tree in args.trees:
+        result = subprocess.run([sys.executable, __file__, "--measure",
+            "--count", str(args.count), tree], check=True,
+            stdout=subprocess.PIPE, universal_newlines=True)
+        print("{0}: {1:.0f} bytes per note".format(os.path.abspath(tree),
+            float(result.stdout)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+#
+# Copyright © 2012-2018 Umang Varma <umang.me@gmail.com>
+#
+# This file is part of indicator-stickynotes.
+#
+# indicator-stickynotes is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# indicator-stickynotes is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# indicator-stickynotes.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares reading the UI files, stylesheets and icons from the resource
+bundle with reading them as separate files
+
+Checks that every file listed in stickynotes.gresource.xml is in the bundle
+with the same contents, including the icons that Gtk.Builder looks up
+relative to the UI files, then times loading all of them both ways. Build
+the bundle first with "./setup.py build_resources"."""
+
+import argparse
+import os.path
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+from gi.repository import Gio, GLib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    ".."))
+from stickynotes.info import RESOURCE_FILE, RESOURCE_PREFIX
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+def bundled_files():
+    """Returns the files listed in stickynotes.gresource.xml"""
+    tree = ET.parse(os.path.join(TOP, "stickynotes.gresource.xml"))
+    return [element.text for element in tree.iter("file")]
+
+def read_resources(files):
+    """Loads the bundle and reads every file from it"""
+    resource = Gio.Resource.load(os.path.join(TOP, RESOURCE_FILE))
+    for filename in files:
+        resource.lookup_data(RESOURCE_PREFIX + filename,
+                Gio.ResourceLookupFlags.NONE).get_data()
+    return resource
+
+def read_files(files):
+    """Reads every file separately from disk"""
+    for filename in files:
+        with open(os.path.join(TOP, filename), "rb") as fsock:
+            fsock.read()
+
+def check(resource, files):
+    """Raises AssertionError if the bundle differs from the files"""
+    for filename in files:
+        with open(os.path.join(TOP, filename), "rb") as fsock:
+            assert resource.lookup_data(RESOURCE_PREFIX + filename,
+                    Gio.ResourceLookupFlags.NONE).get_data() == \
+                            fsock.read(), filename
+    # Gtk.Builder.add_from_resource resolves "Icons/..." against the
+    # directory of the UI file
+    for element in ET.parse(os.path.join(TOP,
+            "StickyNotes.ui")).iter("property"):
+        if element.text and element.text.startswith("Icons/"):
+            resource.open_stream(RESOURCE_PREFIX + element.text,
+                    Gio.ResourceLookupFlags.NONE)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--count", type=int, default=100,
+            help="times to load everything each way")
+    args = parser.parse_args()
+    files = bundled_files()
+    try:
+        check(read_resources(files), files)
+    except GLib.Error as e:
+        sys.exit("Cannot read the bundle ({0}); build it with "
+                "./setup.py build_resources".format(e.message))
+    for name, read, opens in (("resource", read_resources, 1),
+            ("files", read_files, len(files))):
+        start = time.perf_counter()
+        for i in range(args.count):
+            read(files)
+        print("{0:8} {1:6.3f} ms for {2} files, {3} opened".format(name,
+            1000 * (time.perf_counter() - start) / args.count, len(files),
+            opens))
+
+if __name__ == "__main__":
+    main()
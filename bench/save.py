@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+#
+# Copyright © 2012-2018 Umang Varma <umang.me@gmail.com>
+#
+# This file is part of indicator-stickynotes.
+#
+# indicator-stickynotes is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# indicator-stickynotes is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# indicator-stickynotes.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Times a save after editing one note, for growing numbers of untouched
+notes
+
+Only dirty notes are extracted and serialized, so with the incremental
+backends the time should stay flat as the note set grows. The json backend
+still writes the whole file, but reuses the cached fragments of untouched
+notes."""
+
+import argparse
+import os.path
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    ".."))
+from stickynotes.backend import NoteSet, dGUI
+from stickynotes.storage import STORAGE_CLASSES
+
+def note_data(count):
+    return {"notes": [{"uuid": "note-{0}".format(i),
+        "body": "Untouched note {0} ".format(i) * 10,
+        "last_modified": "2018-01-01T00:00:00",
+        "properties": {"position": [10, 10], "size": [200, 150]},
+        "cat": ""} for i in range(count)]}
+
+def time_saves(backend, count, edits, directory):
+    """Returns the mean time in seconds of editing one note and saving"""
+    nset = NoteSet(dGUI, os.path.join(directory, "{0}-{1}".format(backend,
+        count)), None, backend=backend)
+    nset.load_data(note_data(count))
+    # Write everything once, so that only the edits are left to save
+    for note in nset.notes:
+        note.mark_dirty()
+    nset.save()
+    nset.compact(force=True)
+    start = time.perf_counter()
+    for i in range(edits):
+        nset.notes[i].update("Edited note {0}".format(i))
+        nset.save()
+    return (time.perf_counter() - start) / edits
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--backend", action="append",
+            choices=sorted(STORAGE_CLASSES), help="backend to time "
+            "(default: all)")
+    parser.add_argument("--counts", type=int, nargs="+",
+            default=[1000, 10000, 50000], help="numbers of notes")
+    parser.add_argument("--edits", type=int, default=20,
+            help="saves to time for each note set")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        for backend in args.backend or sorted(STORAGE_CLASSES):
+            for count in args.counts:
+                print("{0:8} {1:6} notes: {2:7.2f} ms per save".format(
+                    backend, count, 1000 * time_saves(backend, count,
+                        args.edits, directory)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+#
+# Copyright © 2012-2018 Umang Varma <umang.me@gmail.com>
+#
+# This file is part of indicator-stickynotes.
+#
+# indicator-stickynotes is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# indicator-stickynotes is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# indicator-stickynotes.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Times NoteSet.search() on a large note set
+
+Note bodies are drawn from a vocabulary with Zipf-distributed word
+frequencies, so that queries range from rare words to words in almost
+every note."""
+
+import argparse
+import os.path
+import random
+import string
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    ".."))
+from stickynotes.backend import NoteSet, dGUI
+
+def vocabulary(size):
+    words = {"".join(random.choice(string.ascii_lowercase) for i in
+        range(random.randint(3, 10))) for j in range(size)}
+    return sorted(words)
+
+def time_call(function, repeat):
+    """Returns the mean time in seconds of function() and its result"""
+    start = time.perf_counter()
+    for i in range(repeat):
+        result = function()
+    return (time.perf_counter() - start) / repeat, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--count", type=int, default=10000,
+            help="number of notes")
+    parser.add_argument("--words", type=int, default=60,
+            help="words per note")
+    parser.add_argument("--repeat", type=int, default=20,
+            help="times to run each query")
+    args = parser.parse_args()
+    random.seed(1)
+    vocab = vocabulary(30000)
+    weights = [1 / (i + 1) for i in range(len(vocab))]
+    with tempfile.TemporaryDirectory() as directory:
+        nset = NoteSet(dGUI, os.path.join(directory, "notes"), None,
+                backend="json")
+        nset.load_data({"notes": [{"uuid": "note-{0}".format(i),
+            "body": " ".join(random.choices(vocab, weights, k=args.words)),
+            "last_modified": "2018-01-01T00:00:{0:02}".format(i % 60),
+            "cat": ""} for i in range(args.count)]})
+        elapsed, result = time_call(nset.search_index.refresh, 1)
+        print("building the index: {0:.0f} ms".format(1000 * elapsed))
+        rare, common = vocab[len(vocab) // 6], vocab[3]
+        for query in [rare, common, rare[:3], rare[:1], common + " " + rare,
+                common + " " + rare[:2], "zzzzzzzz"]:
+            elapsed, result = time_call(lambda: nset.search(query),
+                    args.repeat)
+            print("{0!r:24} {1:5} notes: {2:6.2f} ms".format(query,
+                len(result), 1000 * elapsed))
+        note = nset.notes[len(nset.notes) // 2]
+        note.update(note.body + " zebrafish")
+        elapsed, result = time_call(lambda: nset.search("zebrafish"), 1)
+        assert result == [note]
+        print("{0!r:24} after an edit: {1:6.2f} ms".format("zebrafish",
+            1000 * elapsed))
+
+if __name__ == "__main__":
+    main()
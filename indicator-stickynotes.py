@@ -17,27 +17,44 @@
 # You should have received a copy of the GNU General Public License along with
 # indicator-stickynotes.  If not, see <http://www.gnu.org/licenses/>.
 
-from stickynotes.backend import Note, NoteSet
-from stickynotes.gui import *
-import stickynotes.info
-from stickynotes.info import MO_DIR, LOCALE_DOMAIN
-
-import gi
-gi.require_version('Gtk', '3.0')
-gi.require_version('GtkSource', '3.0')
-gi.require_version('AppIndicator3', '0.1')
-from gi.repository import Gtk, Gdk
-from gi.repository import AppIndicator3 as appindicator
+import sys
+
+# Hand requests made on the command line to a running instance before
+# loading GTK, so that they return within milliseconds
+if __name__ == "__main__":
+    from stickynotes.control import forward
+    forward(sys.argv[1:])
+
+# Worker processes of bulk imports run this script again as __mp_main__
+# (see stickynotes.importer), but need neither the GUI nor GTK
+if __name__ != "__mp_main__":
+    from stickynotes.backend import Note, NoteSet, Merge
+    from stickynotes.storage import SaveWorker, BackgroundTask, Cancelled, \
+            write_export
+    from stickynotes.importer import parse_export, read_exports, Malformed
+    from stickynotes.control import ControlServer, add_arguments, \
+            request_from_args, print_response
+    from stickynotes.gui import *
+    import stickynotes.info
+    from stickynotes.info import MO_DIR, LOCALE_DOMAIN
+
+    import gi
+    gi.require_version('Gtk', '3.0')
+    gi.require_version('GtkSource', '3.0')
+    gi.require_version('AppIndicator3', '0.1')
+    from gi.repository import Gtk, Gdk, GLib
+    from gi.repository import AppIndicator3 as appindicator
 
 import os.path
 import locale
 import argparse
 from locale import gettext as _
 from functools import wraps
-from shutil import copyfile, SameFileError
+from shutil import SameFileError
 
+import signal
 import socket
-import sys
+import time
 
 def save_required(f):
     """Wrapper for functions that require a save after execution"""
@@ -51,12 +68,17 @@ def save_required(f):
 class IndicatorStickyNotes:
     def __init__(self, args = None):
         self.args = args
+        self.start_time = time.perf_counter()
         # use development data file if requested
         isdev = args and args.d
         self.data_file = stickynotes.info.DEBUG_SETTINGS_FILE if isdev \
                 else stickynotes.info.SETTINGS_FILE
         # Initialize NoteSet
         self.nset = NoteSet(StickyNote, self.data_file, self)
+        self.nset.scheduler = SaveScheduler(self.nset)
+        self.nset.writer = SaveWorker(self.nset.storage, GLib.idle_add,
+                self.save_finished)
+        self.save_error = None
         try:
             self.nset.open()
         except FileNotFoundError:
@@ -72,13 +94,10 @@ class IndicatorStickyNotes:
             resp = winError.run()
             winError.hide()
             if resp == Gtk.ResponseType.ACCEPT:
-                self.backup_datafile()
+                self.backup_datafile(raw=True)
             winError.destroy()
             self.nset.load_fresh()
 
-        # If all notes were visible previously, show them now
-        if self.nset.properties.get("all_visible", True):
-            self.nset.showall()
         # Create App Indicator
         self.ind = appindicator.Indicator.new(
                 "Sticky Notes", "indicator-stickynotes",
@@ -110,6 +129,11 @@ class IndicatorStickyNotes:
         self.mHideAll.connect("activate", self.hideall, None)
         self.mHideAll.show()
 
+        self.mSearch = Gtk.MenuItem(_("Search..."))
+        self.menu.append(self.mSearch)
+        self.mSearch.connect("activate", self.show_search, None)
+        self.mSearch.show()
+
         s = Gtk.SeparatorMenuItem.new()
         self.menu.append(s)
         s.show()
@@ -138,6 +162,21 @@ class IndicatorStickyNotes:
         self.mImport.connect("activate", self.import_datafile, None)
         self.mImport.show()
 
+        self.mImportFolder = Gtk.MenuItem(_("Import Folder"))
+        self.menu.append(self.mImportFolder)
+        self.mImportFolder.connect("activate", self.import_folder, None)
+        self.mImportFolder.show()
+
+        # Progress of a running import or export, hidden otherwise
+        self.task = None
+        self.mProgress = Gtk.MenuItem("")
+        self.menu.append(self.mProgress)
+        self.mProgress.set_sensitive(False)
+
+        self.mCancel = Gtk.MenuItem(_("Cancel"))
+        self.menu.append(self.mCancel)
+        self.mCancel.connect("activate", self.cancel_task, None)
+
         s = Gtk.SeparatorMenuItem.new()
         self.menu.append(s)
         s.show()
@@ -163,9 +202,62 @@ class IndicatorStickyNotes:
         # Connect Indicator to menu
         self.ind.set_menu(self.menu)
 
+        # If all notes were visible previously, show them a few at a time
+        # once the main loop is running, so the indicator appears first
+        show_notes = self.nset.properties.get("all_visible", True)
+        self.nset.properties["all_visible"] = show_notes
+
         # Define secondary action (middle click)
         self.connect_secondary_activate()
 
+        self.report_time("indicator")
+        if show_notes:
+            GLib.idle_add(self.show_batch, iter(self.nset.recent_first()))
+        else:
+            self.report_time("notes")
+
+        # Build the search index in the background, unless note bodies are
+        # only loaded when needed
+        self.search_dialog = None
+        if not self.nset.storage.lazy_bodies:
+            self.nset.search_index.build()
+            GLib.idle_add(self.index_batch, priority=GLib.PRIORITY_LOW)
+
+        # Periodically fold the journal back into the data file
+        GLib.timeout_add_seconds(stickynotes.info.COMPACT_INTERVAL,
+                self.compact)
+
+    def report_time(self, milestone):
+        """Prints the time since startup if requested on the command line"""
+        if self.args and self.args.timing:
+            print("{0}: {1:.1f} ms".format(milestone,
+                1000 * (time.perf_counter() - self.start_time)),
+                file=sys.stderr)
+
+    def report_styles(self):
+        """Prints how many style providers are attached if requested on the
+        command line"""
+        if self.args and self.args.timing:
+            print("style providers: {screen} on screen, {category} for "
+                    "categories, attached {attached} times".format(
+                        **count_style_providers()), file=sys.stderr)
+
+    def show_batch(self, notes):
+        """Shows the next few notes from the startup queue"""
+        # Stop if the user hid all notes in the meantime
+        if self.nset.properties["all_visible"]:
+            shown = 0
+            for note in notes:
+                # Notes shown by other means already have a window
+                if note.gui == None:
+                    note.show()
+                    shown += 1
+                if shown >= stickynotes.info.STARTUP_BATCH:
+                    return True
+        self.report_time("notes")
+        self.report_styles()
+        return False
+
     def new_note(self, *args):
         self.nset.new()
 
@@ -196,7 +288,11 @@ class IndicatorStickyNotes:
         for note in self.nset.notes:
             note.set_locked_state(False)
 
-    def backup_datafile(self):
+    def backup_datafile(self, raw=False):
+        """Exports the notes to a file chosen by the user
+
+        If raw is set, the data file is copied as is instead (e.g. when it
+        could not be read)."""
         winChoose = Gtk.FileChooserDialog(_("Export Data"), None,
                 Gtk.FileChooserAction.SAVE, (Gtk.STOCK_CANCEL,
                     Gtk.ResponseType.CANCEL, Gtk.STOCK_SAVE,
@@ -208,8 +304,16 @@ class IndicatorStickyNotes:
             backupfile =  winChoose.get_filename()
         winChoose.destroy()
         if backupfile:
+            data_file = os.path.expanduser(self.data_file)
             try:
-                copyfile(os.path.expanduser(self.data_file), backupfile)
+                if raw:
+                    self.nset.storage.copy_raw(backupfile)
+                elif os.path.exists(backupfile) and \
+                        os.path.exists(data_file) and \
+                        os.path.samefile(data_file, backupfile):
+                    raise SameFileError(data_file, backupfile)
+                else:
+                    self.export_to(backupfile)
             except SameFileError:
                 err = _("Please choose a different "
                     "destination for the backup file.")
@@ -217,7 +321,7 @@ class IndicatorStickyNotes:
                         Gtk.MessageType.ERROR, Gtk.ButtonsType.CLOSE, err)
                 winError.run()
                 winError.destroy()
-                self.backup_datafile()
+                self.backup_datafile(raw)
 
     def export_datafile(self, *args):
         self.backup_datafile()
@@ -227,30 +331,292 @@ class IndicatorStickyNotes:
                 Gtk.FileChooserAction.OPEN, (Gtk.STOCK_CANCEL,
                     Gtk.ResponseType.CANCEL, Gtk.STOCK_OPEN,
                     Gtk.ResponseType.ACCEPT))
+        winChoose.set_select_multiple(True)
         response = winChoose.run()
-        backupfile = None
+        backupfiles = []
         if response == Gtk.ResponseType.ACCEPT:
-            backupfile =  winChoose.get_filename()
+            backupfiles = winChoose.get_filenames()
         winChoose.destroy()
-        if backupfile:
-            try:
-                with open(backupfile, encoding="utf-8") as fsock:
-                    self.nset.merge(fsock.read())
-            except Exception as e:
-                err = _("Error importing data.")
-                winError = Gtk.MessageDialog(None, None,
-                        Gtk.MessageType.ERROR, Gtk.ButtonsType.CLOSE, err)
-                winError.run()
-                winError.destroy()
+        if len(backupfiles) == 1:
+            self.import_from(backupfiles[0])
+        elif backupfiles:
+            self.bulk_import(backupfiles)
+
+    def import_folder(self, *args):
+        """Imports all exports in a folder chosen by the user"""
+        winChoose = Gtk.FileChooserDialog(_("Import Folder"), None,
+                Gtk.FileChooserAction.SELECT_FOLDER, (Gtk.STOCK_CANCEL,
+                    Gtk.ResponseType.CANCEL, Gtk.STOCK_OPEN,
+                    Gtk.ResponseType.ACCEPT))
+        response = winChoose.run()
+        folder = None
+        if response == Gtk.ResponseType.ACCEPT:
+            folder = winChoose.get_filename()
+        winChoose.destroy()
+        if folder:
+            self.bulk_import([folder])
+
+    def run_task(self, label, function, finished):
+        """Runs function(task) in the background, showing its progress in
+        the menu; finished(result, error) is called at the end"""
+        self.task_label = label
+        self.mProgress.set_label(label)
+        self.mProgress.show()
+        self.mCancel.show()
+        self.mExport.set_sensitive(False)
+        self.mImport.set_sensitive(False)
+        self.mImportFolder.set_sensitive(False)
+        def _finished(result, error):
+            self.task = None
+            self.mProgress.hide()
+            self.mCancel.hide()
+            self.mExport.set_sensitive(True)
+            self.mImport.set_sensitive(True)
+            self.mImportFolder.set_sensitive(True)
+            finished(result, error)
+        self.task = BackgroundTask(function, GLib.idle_add,
+                self.task_progress, _finished)
+
+    def task_progress(self, fraction):
+        self.mProgress.set_label("{0} ({1:.0%})".format(self.task_label,
+            fraction))
+
+    def cancel_task(self, *args):
+        if self.task:
+            self.task.cancel()
+
+    def export_to(self, path, finished=None):
+        """Exports the notes as they are now, writing in the background
+
+        finished(result, error) is called at the end, if given; by default
+        errors are shown to the user."""
+        snapshot = self.nset.export_snapshot()
+        self.run_task(_("Exporting data"),
+                lambda task: write_export(path, snapshot, task),
+                finished or self.export_finished)
+
+    def export_finished(self, result, error):
+        if error is not None and not isinstance(error, Cancelled):
+            err = _("Error exporting data.") + "\n\n" + str(error)
+            winError = Gtk.MessageDialog(None, None,
+                    Gtk.MessageType.ERROR, Gtk.ButtonsType.CLOSE, err)
+            winError.run()
+            winError.destroy()
+
+    def import_from(self, path):
+        """Merges an export into the notes, parsing it in the background
+
+        Notes are merged on the main loop a batch at a time. If the import is
+        cancelled, the notes merged so far are kept."""
+        merge = Merge(self.nset)
+        def _merge_batch(batch):
+            for key, value in batch:
+                merge.feed(key, value)
+        def _import(task):
+            with open(path, encoding="utf-8") as fsock:
+                size = os.fstat(fsock.fileno()).st_size
+                batch = []
+                try:
+                    for item in parse_export(fsock):
+                        batch.append(item)
+                        if len(batch) >= stickynotes.info.IMPORT_BATCH:
+                            task.call(_merge_batch, batch)
+                            batch = []
+                            task.progress(fsock.buffer.tell(), size)
+                except ValueError as e:
+                    task.call(_merge_batch, batch)
+                    task.call(merge.broken_off, e)
+                else:
+                    task.call(_merge_batch, batch)
+        self.run_task(_("Importing data"), _import,
+                lambda result, error: self.import_finished(merge, error))
+
+    def import_finished(self, merge, error):
+        report = merge.finish()
+        category_menu.update(self.nset)
+        if error is not None and not isinstance(error, Cancelled) and \
+                not merge.read:
+            err = _("Error importing data.") + "\n\n" + str(error)
+            winError = Gtk.MessageDialog(None, None,
+                    Gtk.MessageType.ERROR, Gtk.ButtonsType.CLOSE, err)
+            winError.run()
+            winError.destroy()
+        else:
+            if error is not None and not isinstance(error, Cancelled):
+                report.malformed.append(Malformed(None, str(error)))
+            self.show_merge_report(report, isinstance(error, Cancelled))
+
+    def bulk_import(self, paths):
+        """Imports many exports (or folders of them) at once
+
+        The files are parsed in parallel processes and the newest copy of
+        every note is merged in a single merge."""
+        merge = Merge(self.nset)
+        start_time = time.perf_counter()
+        def _merge_notes(notes):
+            for note in notes:
+                merge.note(note)
+        def _import(task):
+            bulk = read_exports(paths, task)
+            task.call(merge.categories, bulk.categories)
+            notes = list(bulk.notes.values())
+            for i in range(0, len(notes), stickynotes.info.IMPORT_BATCH):
+                task.call(_merge_notes,
+                        notes[i:i + stickynotes.info.IMPORT_BATCH])
+                task.progress(i, len(notes))
+            return bulk
+        self.run_task(_("Importing data"), _import,
+                lambda bulk, error: self.bulk_import_finished(merge, bulk,
+                    error, start_time))
+
+    def bulk_import_finished(self, merge, bulk, error, start_time):
+        report = merge.finish()
+        category_menu.update(self.nset)
+        if error is not None and not isinstance(error, Cancelled):
+            err = _("Error importing data.") + "\n\n" + str(error)
+            winError = Gtk.MessageDialog(None, None,
+                    Gtk.MessageType.ERROR, Gtk.ButtonsType.CLOSE, err)
+            winError.run()
+            winError.destroy()
+            return
+        summary = None
+        if bulk:
+            report.malformed.extend(bulk.malformed)
+            elapsed = time.perf_counter() - start_time
+            summary = _("Read {0} notes from {1} files in {2:.1f} s "
+                    "({3:.0f} notes per second).").format(bulk.read,
+                        bulk.files, elapsed, bulk.read / max(elapsed, 1e-6))
+            if self.args and self.args.timing:
+                print(summary, file=sys.stderr)
+        self.show_merge_report(report, isinstance(error, Cancelled),
+                summary)
+
+    def show_merge_report(self, report, cancelled=False, summary=None):
+        """Tells the user what an import changed"""
+        msg = _("Added {0} notes and updated {1}; {2} were already up "
+                "to date.").format(len(report.added), len(report.updated),
+                    len(report.unchanged))
+        if summary:
+            msg = summary + " " + msg
+        if cancelled:
+            msg = _("The import was cancelled.") + " " + msg
+        if report.conflicts:
+            msg += " " + _("{0} notes were kept as they are because they "
+                    "were changed here more recently.").format(
+                        len(report.conflicts))
+        if report.malformed:
+            msg += "\n\n" + _("{0} entries could not be imported:").format(
+                    len(report.malformed))
+            for entry in report.malformed[:10]:
+                if entry.index is None:
+                    msg += "\n" + entry.error
+                else:
+                    msg += "\n" + _("Note {0}: {1}").format(entry.index + 1,
+                            entry.error)
+            if len(report.malformed) > 10:
+                msg += "\n..."
+        winInfo = Gtk.MessageDialog(None, None, Gtk.MessageType.INFO,
+                Gtk.ButtonsType.CLOSE, msg)
+        winInfo.set_title(_("Import Data"))
+        winInfo.run()
+        winInfo.destroy()
+
+    def control(self, request, reply):
+        """Carries out a request from the command line (see
+        stickynotes.control) and calls reply with the response"""
+        command = request.get("command")
+        if command == "new-note":
+            self.nset.new(str(request.get("body", "")))
+        elif command == "show-all":
+            self.showall()
+        elif command == "hide-all":
+            self.hideall()
+        elif command == "search":
+            notes = self.nset.search(str(request.get("query", "")))
+            reply({"ok": True, "notes": [{"uuid": note.uuid,
+                "body": note.body} for note in notes]})
+            return
+        elif command in ("export", "import"):
+            if self.task:
+                reply({"ok": False, "error": _("Another import or export "
+                    "is in progress.")})
+                return
+            if command == "export":
+                path = str(request.get("path", ""))
+                data_file = os.path.expanduser(self.data_file)
+                if os.path.exists(path) and os.path.exists(data_file) and \
+                        os.path.samefile(data_file, path):
+                    reply({"ok": False, "error": _("Cannot export to the "
+                        "data file.")})
+                    return
+                def _exported(result, error):
+                    if error is None:
+                        reply({"ok": True})
+                    else:
+                        reply({"ok": False, "error": str(error)})
+                self.export_to(path, _exported)
+                return
+            paths = [str(path) for path in request.get("paths", [])]
+            if len(paths) == 1 and not os.path.isdir(paths[0]):
+                self.import_from(paths[0])
+            elif paths:
+                self.bulk_import(paths)
+        else:
+            reply({"ok": False, "error": _("Unknown command: {0}").format(
+                command)})
+            return
+        reply({"ok": True})
 
     def show_about(self, *args):
         show_about_dialog()
 
+    def show_search(self, *args):
+        if self.search_dialog is None:
+            self.search_dialog = SearchDialog(self.nset)
+            self.search_dialog.wSearch.connect("destroy",
+                    self.search_closed)
+        self.search_dialog.present()
+
+    def search_closed(self, *args):
+        self.search_dialog = None
+
+    def index_batch(self):
+        """Adds the next few notes to the search index"""
+        return self.nset.search_index.refresh(stickynotes.info.INDEX_BATCH)
+
     def show_settings(self, *args):
         wSettings = SettingsDialog(self.nset)
+        # Restyling categories must not leave extra providers behind
+        self.report_styles()
 
     def save(self):
-        self.nset.save()
+        self.nset.request_save()
+
+    def flush(self):
+        """Writes out all pending changes, e.g. before quitting"""
+        self.nset.flush(compact=True)
+
+    def save_finished(self, error):
+        """Reports the outcome of a background save"""
+        if error is None:
+            if self.save_error:
+                self.save_error.destroy()
+                self.save_error = None
+        elif self.save_error is None:
+            # Only keep a single error dialog around until a save succeeds
+            err = _("Error saving data file.")
+            self.save_error = Gtk.MessageDialog(None, None,
+                    Gtk.MessageType.ERROR, Gtk.ButtonsType.CLOSE, err)
+            self.save_error.format_secondary_text(str(error))
+            self.save_error.set_title(_("Indicator Stickynotes"))
+            self.save_error.connect("response",
+                    lambda dialog, resp: dialog.hide())
+            self.save_error.show()
+        return False
+
+    def compact(self, force=False):
+        self.nset.compact(force)
+        return True
 
 def main():
     # Avoid duplicate process
@@ -278,13 +644,35 @@ def main():
     parser = argparse.ArgumentParser(description=_("Sticky Notes"))
     parser.add_argument("-d", action='store_true', help="use the development"
             " data file")
+    parser.add_argument("--timing", action='store_true', help="report "
+            "startup times on standard error")
+    add_arguments(parser)
     args = parser.parse_args()
 
     indicator = IndicatorStickyNotes(args)
+    # Listen for requests from later invocations
+    def _watch(fd, callback):
+        GLib.io_add_watch(fd, GLib.PRIORITY_DEFAULT,
+                GLib.IO_IN | GLib.IO_HUP, lambda *args: callback())
+    try:
+        server = ControlServer(indicator.control, _watch)
+    except OSError as e:
+        print("Cannot listen for requests: {0}".format(e), file=sys.stderr)
+    # Carry out the request on the command line ourselves
+    request = request_from_args(args)
+    if request is not None:
+        indicator.control(request, print_response)
     # Load global css for the first time.
     load_global_css()
+    # Logging out terminates the session's processes; quit the main loop
+    # instead of dying, so that pending edits are still written out
+    def _quit(*args):
+        Gtk.main_quit()
+        return True
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        GLib.unix_signal_add(GLib.PRIORITY_HIGH, signum, _quit)
     Gtk.main()
-    indicator.save()
+    indicator.flush()
 
 if __name__ == "__main__":
     main()
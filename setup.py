@@ -31,7 +31,7 @@ import sys
 import shutil
 
 sys.dont_write_bytecode = True
-from stickynotes.info import PO_DIR, MO_DIR, LOCALE_DOMAIN
+from stickynotes.info import PO_DIR, MO_DIR, LOCALE_DOMAIN, RESOURCE_FILE
 sys.dont_write_bytecode = False
 
 class BuildPo(Command):
@@ -58,16 +58,41 @@ class BuildPo(Command):
                 raise Exception("Error: msgfmt returned error code {0}" \
                         .format(ret))
 
+class BuildResources(Command):
+    """Compiles the UI files, stylesheets and icons into a resource bundle
+
+    The bundle is loaded once at startup instead of opening every file"""
+    user_options = []
+    def initialize_options(self):
+        pass
+    def finalize_options(self):
+        pass
+    def run(self):
+        """Compiles stickynotes.gresource.xml to RESOURCE_FILE"""
+        try:
+            ret = call(["glib-compile-resources", "--sourcedir=.",
+                "--target=" + RESOURCE_FILE, "stickynotes.gresource.xml"])
+        except OSError:
+            raise Exception("Error: Unable to run glib-compile-resources")
+        if ret:
+            raise Exception("Error: glib-compile-resources returned error "
+                    "code {0}".format(ret))
+
 class Build(distutils.command.build.build):
-    # build should depend on build_po
+    # build should depend on build_po and build_resources
     sub_commands = distutils.command.build.build.sub_commands + \
-            [('build_po', None)]
+            [('build_po', None), ('build_resources', None)]
 
 class Clean(distutils.command.clean.clean):
     def run(self):
         # delete MO_DIR files before cleaning everything else
         print("Deleting {0}/ and contents".format(MO_DIR))
         shutil.rmtree(MO_DIR, ignore_errors=True)
+        print("Deleting {0}".format(RESOURCE_FILE))
+        try:
+            os.remove(RESOURCE_FILE)
+        except FileNotFoundError:
+            pass
         return super().run()
 
 class InstallData(distutils.command.install_data.install_data):
@@ -83,7 +108,7 @@ def main():
     # Default data files
     data_files = [('', ('COPYING', 'style.css', 'StickyNotes.ui',
                     'style_global.css', 'GlobalDialogs.ui',
-                    'SettingsCategory.ui')),
+                    'SettingsCategory.ui', RESOURCE_FILE)),
                 ('/usr/share/applications', ('indicator-stickynotes.desktop',)),
                 ('Icons', glob.glob("Icons/*.png"))]
     # Icon themes
@@ -104,7 +129,8 @@ def main():
             scripts=['indicator-stickynotes.py',],
             data_files=data_files,
             cmdclass={'build': Build, 'install_data': InstallData,
-                'build_po': BuildPo, 'clean':Clean},
+                'build_po': BuildPo, 'build_resources': BuildResources,
+                'clean':Clean},
             long_description="Write reminders on notes with Indicator "
                 "Stickynotes")
 
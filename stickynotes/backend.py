@@ -15,54 +15,172 @@
 # You should have received a copy of the GNU General Public License along with
 # indicator-stickynotes.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import namedtuple
+from copy import deepcopy
 from datetime import datetime
 import uuid
+import io
 import json
+import sys
 from os.path import expanduser
 
-from stickynotes.info import FALLBACK_PROPERTIES
+from stickynotes.info import FALLBACK_PROPERTIES, STORAGE_BACKEND
+from stickynotes.storage import open_storage, dumps_fragments, \
+        atomic_write, Snapshot, ExportSnapshot
+from stickynotes.search import SearchIndex
+from stickynotes.importer import parse_export, Malformed
 
 class Note:
-    def __init__(self, content=None, gui_class=None, noteset=None,
-            category=None):
-        self.gui_class = gui_class
+    # Notes are kept compact since large archives hold tens of thousands
+    __slots__ = ("noteset", "uuid", "_body", "_category", "_last_modified",
+            "position", "size", "locked", "_extra_properties", "_fragment",
+            "dirty", "gui")
+
+    def __init__(self, content=None, noteset=None, category=None):
         self.noteset = noteset
         content = content or {}
-        self.uuid = content.get('uuid')
-        self.body = content.get('body','')
+        self.uuid = content.get('uuid') or str(uuid.uuid4())
+        # Stored notes may come without their body, which is then only
+        # fetched from the storage once it is needed
+        self._body = content.get('body', None if content.get('uuid') else '')
         self.properties = content.get("properties", {})
-        self.category = category or content.get("cat", "")
-        if not self.category in self.noteset.categories:
-            self.category = ""
-        last_modified = content.get('last_modified')
-        if last_modified:
-            self.last_modified = datetime.strptime(last_modified,
-                    "%Y-%m-%dT%H:%M:%S")
-        else:
-            self.last_modified = datetime.now()
+        category = category or content.get("cat", "")
+        if not category in self.noteset.categories:
+            category = ""
+        # The note set indexes the note under its category once it is added
+        self._category = sys.intern(category)
+        # Kept as the stored string until somebody needs the datetime
+        self._last_modified = content.get('last_modified') or datetime.now()
+        # Serialized note, cached until the note is modified
+        self._fragment = None
+        self.dirty = False
         # Don't create GUI until show is called
         self.gui = None
+        # Notes that are not exactly as they were loaded need to be saved
+        if not (content.get('uuid') and
+                self.category == content.get("cat", "")):
+            self.mark_dirty()
 
-    def extract(self):
-        if not self.uuid:
-            self.uuid = str(uuid.uuid4())
+    @property
+    def gui_class(self):
+        return self.noteset.gui_class
+
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = self.noteset.storage.load_body(self.uuid) or ''
+        return self._body
+
+    @body.setter
+    def body(self, body):
+        self._body = body
+        self.noteset.body_changed(self)
+
+    @property
+    def category(self):
+        return self._category
+
+    @category.setter
+    def category(self, category):
+        old, self._category = self._category, sys.intern(category)
+        self.noteset.recategorize(self, old)
+
+    @property
+    def last_modified(self):
+        if isinstance(self._last_modified, str):
+            self._last_modified = datetime.strptime(self._last_modified,
+                    "%Y-%m-%dT%H:%M:%S")
+        return self._last_modified
+
+    @last_modified.setter
+    def last_modified(self, last_modified):
+        self._last_modified = last_modified
+
+    @property
+    def last_modified_str(self):
+        """last_modified in the stored format, which sorts chronologically"""
+        if isinstance(self._last_modified, str):
+            return self._last_modified
+        return self._last_modified.strftime("%Y-%m-%dT%H:%M:%S")
+
+    @property
+    def properties(self):
+        """The note's position, size, locked state and any other property
+
+        This is a new dictionary; assign to it rather than modifying it."""
+        prop = {}
+        if self.position is not None:
+            prop["position"] = self.position
+        if self.size is not None:
+            prop["size"] = self.size
+        if self.locked is not None:
+            prop["locked"] = self.locked
+        if self._extra_properties:
+            prop.update(self._extra_properties)
+        return prop
+
+    @properties.setter
+    def properties(self, properties):
+        properties = dict(properties or {})
+        position = properties.pop("position", None)
+        size = properties.pop("size", None)
+        self.position = tuple(position) if position is not None else None
+        self.size = tuple(size) if size is not None else None
+        self.locked = properties.pop("locked", None)
+        self._extra_properties = properties or None
+
+    def mark_dirty(self):
+        """Marks the note (or its GUI) as changed since it was last saved"""
+        self.dirty = True
+        self._fragment = None
+        self.noteset.touch(self)
+
+    def to_dict(self):
+        """Returns the note as a dictionary, without consulting the GUI"""
+        return {"uuid":self.uuid, "body":self.body,
+                "last_modified":self.last_modified_str,
+                "properties":self.properties, "cat": self.category}
+
+    def update_from_gui(self):
+        """Takes over unsaved text and geometry from the note's window"""
         if self.gui != None:
             self.gui.update_note()
             self.properties = self.gui.properties()
-        return {"uuid":self.uuid, "body":self.body,
-                "last_modified":self.last_modified.strftime(
-                    "%Y-%m-%dT%H:%M:%S"), "properties":self.properties,
-                "cat": self.category}
+
+    def extract(self):
+        self.update_from_gui()
+        return self.to_dict()
+
+    def fragment(self):
+        """Returns the note serialized as JSON
+
+        The GUI is only consulted if the note is dirty, and the result is
+        cached until the note is marked dirty again."""
+        if self.dirty:
+            self._fragment = json.dumps(self.extract())
+            self.dirty = False
+        elif self._fragment is None:
+            self._fragment = json.dumps(self.to_dict())
+        return self._fragment
+
+    def export_entry(self):
+        """Returns the note serialized like fragment(), or as a dictionary
+        with a placeholder body if the body has not been loaded yet"""
+        if self._body is None and not self.dirty:
+            return {"uuid":self.uuid, "body":None,
+                    "last_modified":self.last_modified_str,
+                    "properties":self.properties, "cat": self.category}
+        return self.fragment()
 
     def update(self,body=None):
-        if not body == None:
+        if not body == None and body != self.body:
             self.body = body
             self.last_modified = datetime.now()
+            self.mark_dirty()
 
     def delete(self):
-        self.noteset.notes.remove(self)
-        self.noteset.save()
-        del self
+        self.noteset.remove(self)
+        self.noteset.request_save()
 
     def show(self, *args, **kwargs):
         # If GUI has not been created, create it now
@@ -78,7 +196,9 @@ class Note:
     def set_locked_state(self, locked):
         # if gui hasn't been initialized, just change the property
         if self.gui == None:
-            self.properties["locked"] = locked
+            if bool(self.locked) != locked:
+                self.locked = locked
+                self.mark_dirty()
         else:
             self.gui.set_locked_state(locked)
 
@@ -88,13 +208,38 @@ class Note:
 
 
 class NoteSet:
-    def __init__(self, gui_class, data_file, indicator):
+    """A set of notes and their categories
+
+    Category properties are memoized, so categories and the default category
+    should only be changed through the methods provided for it (or followed
+    by a call to invalidate_categories)."""
+    def __init__(self, gui_class, data_file, indicator,
+            backend=STORAGE_BACKEND):
         self.notes = []
         self.properties = {}
         self.categories = {}
+        # (category, property) -> resolved value
+        self._category_cache = {}
+        # Incremented whenever resolved category properties may change
+        self.categories_version = 0
         self.gui_class = gui_class
         self.data_file = data_file
         self.indicator = indicator
+        self.storage = open_storage(data_file, backend)
+        # Object with request() and flush() methods that decides when
+        # request_save() actually saves
+        self.scheduler = None
+        # SaveWorker that writes snapshots in the background, if any
+        self.writer = None
+        # Notes changed and uuids deleted since the last save
+        self._changed = {}
+        self._deleted = set()
+        # Category id -> notes stored with it (as keys of a dict, which
+        # keeps them in order); see index_note
+        self._by_category = {}
+        # uuid -> note, for looking notes up without scanning the list
+        self._by_uuid = {}
+        self.search_index = SearchIndex(self)
 
     def _loads_updater(self, dnoteset):
         """Parses old versions of the Notes structure and updates them"""
@@ -102,26 +247,119 @@ class NoteSet:
 
     def loads(self, snoteset):
         """Loads notes into their respective objects"""
-        notes = self._loads_updater(json.loads(snoteset))
+        self.load_data(json.loads(snoteset))
+
+    def load_data(self, dnoteset):
+        """Loads already parsed notes into their respective objects"""
+        notes = self._loads_updater(dnoteset)
         self.properties = notes.get("properties", {})
         self.categories = notes.get("categories", {})
-        self.notes = [Note(note, gui_class=self.gui_class, noteset=self)
+        self.invalidate_categories()
+        self._changed = {}
+        self._deleted = set()
+        self.notes = [Note(note, noteset=self)
                 for note in notes.get("notes",[])]
+        self._by_category = {}
+        self._by_uuid = {}
+        for note in self.notes:
+            self._by_uuid[note.uuid] = note
+            self.index_note(note)
+        self.search_index.clear()
 
     def dumps(self):
-        return json.dumps({"notes":[x.extract() for x in self.notes],
-            "properties": self.properties, "categories": self.categories})
+        return dumps_fragments([n for u, n in self.fragments()],
+                json.dumps(self.properties), json.dumps(self.categories))
+
+    def fragments(self):
+        """Returns a list of (uuid, serialized note) pairs"""
+        return [(note.uuid, note.fragment()) for note in self.notes]
 
     def save(self, path=''):
-        output = self.dumps()
-        with open(path or expanduser(self.data_file),
-                mode='w', encoding='utf-8') as fsock:
-            fsock.write(output)
+        """Saves to the data file, or exports a JSON file to path"""
+        if path:
+            atomic_write(expanduser(path), self.dumps())
+            return
+        snapshot = self.snapshot()
+        if self.writer:
+            self.writer.submit(snapshot)
+        else:
+            self.storage.save(snapshot)
+        self._changed = {}
+        self._deleted = set()
+
+    def export_snapshot(self):
+        """Returns an ExportSnapshot of the note set as it is now"""
+        notes = [note.export_entry() for note in self.notes]
+        bodies = None
+        if not all(isinstance(note, str) for note in notes):
+            bodies = self.storage.body_snapshot()
+        return ExportSnapshot(notes, json.dumps(self.properties),
+                json.dumps(self.categories), bodies)
+
+    def snapshot(self):
+        """Returns a Snapshot of everything that has to be saved"""
+        notes = None if self.storage.incremental else tuple(self.fragments())
+        return Snapshot(notes,
+                tuple((note.uuid, note.fragment()) for note in self._changed),
+                frozenset(self._deleted), deepcopy(self.properties),
+                deepcopy(self.categories))
+
+    def request_save(self):
+        """Saves now, or soon if a scheduler is attached"""
+        if self.scheduler:
+            self.scheduler.request()
+        else:
+            self.save()
+
+    def flush(self, compact=False):
+        """Performs any pending save (and compaction) and waits for it"""
+        if self.scheduler:
+            self.scheduler.flush()
+        else:
+            self.save()
+        if compact:
+            self.compact(force=True)
+        if self.writer:
+            self.writer.wait()
+
+    def touch(self, note):
+        """Records that a note has to be written on the next save"""
+        self._changed[note] = None
+
+    def remove(self, note):
+        """Removes a note from the note set"""
+        self.notes.remove(note)
+        if self._by_uuid.get(note.uuid) is note:
+            del self._by_uuid[note.uuid]
+        self.unindex_note(note, note.category)
+        self.search_index.remove(note)
+        self._changed.pop(note, None)
+        self._deleted.add(note.uuid)
+
+    def body_changed(self, note):
+        """Records that the text of a note changed (possibly only in its
+        window)"""
+        self.search_index.add(note)
+
+    def search(self, query):
+        """Returns the notes containing every word of query, most recently
+        modified first"""
+        return sorted(self.search_index.search(query),
+                key=lambda n: n.last_modified_str, reverse=True)
 
     def open(self, path=''):
-        with open(path or expanduser(self.data_file), 
-                encoding='utf-8') as fsock:
-            self.loads(fsock.read())
+        if path:
+            with open(expanduser(path), encoding='utf-8') as fsock:
+                self.loads(fsock.read())
+        else:
+            self.load_data(self.storage.load())
+
+    def compact(self, force=False):
+        """Compacts the data file if the storage backend requires it"""
+        if self.writer:
+            self.writer.compact(force)
+        elif force or self.storage.needs_compaction():
+            self.storage.compact()
 
     def load_fresh(self):
         """Load empty data"""
@@ -129,79 +367,313 @@ class NoteSet:
         self.new()
 
     def merge(self, data):
-        """Update notes based on new data"""
-        jdata = self._loads_updater(json.loads(data))
-        self.hideall()
-        # update categories
-        if "categories" in jdata:
-            self.categories.update(jdata["categories"])
-        # make a dictionary of notes so we can modify existing notes
-        dnotes = {n.uuid : n for n in self.notes}
-        for newnote in jdata.get("notes", []):
-            if "uuid" in newnote and newnote["uuid"] in dnotes:
-                # Update notes that are already in the noteset
-                orignote = dnotes[newnote["uuid"]]
-                if "body" in newnote:
-                    orignote.body = newnote["body"]
-                if "properties" in newnote:
-                    orignote.properties = newnote["properties"]
-                if "cat" in newnote:
-                    orignote.category = newnote["cat"]
-            else:
-                # otherwise create a new note
-                if "uuid" in newnote:
-                    uuid = newnote["uuid"]
-                else:
-                    uuid = str(uuid.uuid4())
-                dnotes[uuid] = Note(newnote, gui_class=self.gui_class,
-                        noteset=self)
-        # copy notes over from dictionary to list
-        self.notes = list(dnotes.values())
-        self.showall(reload_from_backend=True)
-
-    def new(self):
-        """Creates a new note and adds it to the note set"""
-        note = Note(gui_class=self.gui_class, noteset=self,
+        """Merges exported data into the note set; returns a MergeReport"""
+        return self.merge_file(io.StringIO(data))
+
+    def merge_file(self, fsock):
+        """Merges an export read from a file object; returns a MergeReport
+
+        Notes are merged one at a time as they are parsed. Malformed notes
+        are skipped and listed in the report. If the file is not an export
+        at all, ValueError is raised; if it only breaks off after some notes
+        (e.g. because it was truncated), those are kept and the error is
+        listed as a Malformed entry without index."""
+        merge = Merge(self)
+        try:
+            for key, value in parse_export(fsock):
+                merge.feed(key, value)
+        except ValueError as e:
+            merge.broken_off(e)
+        return merge.finish()
+
+    def new(self, body=""):
+        """Creates a new note, optionally with some text, and adds it to the
+        note set"""
+        note = Note({"body": body} if body else None, noteset=self,
                 category=self.properties.get("default_cat", ""))
-        self.notes.append(note)
+        self.add(note)
         note.show()
         return note
 
+    def add(self, note):
+        """Adds a note created for this note set to it"""
+        self.notes.append(note)
+        self._by_uuid[note.uuid] = note
+        self.index_note(note)
+        self.search_index.add(note)
+
+    def find(self, nuuid):
+        """Returns the note with the given uuid, or None"""
+        return self._by_uuid.get(nuuid)
+
+    def recent_first(self):
+        """Returns the notes, most recently modified first"""
+        return sorted(self.notes, key=lambda n: n.last_modified_str,
+                reverse=True)
+
     def showall(self, *args, **kwargs):
         for note in self.notes:
             note.show(*args, **kwargs)
         self.properties["all_visible"] = True
 
     def hideall(self, *args):
-        self.save()
+        self.request_save()
         for note in self.notes:
             note.hide(*args)
         self.properties["all_visible"] = False
 
-    def get_category_property(self, cat, prop):
-        """Get a property of a category or the default"""
+    def index_note(self, note):
+        """Adds a note of the note set to the category index"""
+        self._by_category.setdefault(note.category, {})[note] = None
+
+    def unindex_note(self, note, cat):
+        """Removes a note from the category index entry of cat"""
+        notes = self._by_category.get(cat)
+        if notes is None or note not in notes:
+            return False
+        del notes[note]
+        if not notes:
+            del self._by_category[cat]
+        return True
+
+    def recategorize(self, note, old):
+        """Moves a note in the category index after its category changed"""
+        # Notes which are not (yet) part of the set are not indexed
+        if self.unindex_note(note, old):
+            self.index_note(note)
+
+    def category_notes(self, cat):
+        """Returns the notes stored with the category id cat"""
+        return list(self._by_category.get(cat, ()))
+
+    def uncategorized_notes(self):
+        """Returns the notes without a category or whose category no longer
+        exists, which fall back to the default category"""
+        return [note for cat, notes in self._by_category.items()
+                if not (cat and cat in self.categories) for note in notes]
+
+    def styled_notes(self, cat):
+        """Returns the notes that take their properties from category cat"""
+        notes = self.category_notes(cat)
+        if cat and cat == self.properties.get("default_cat", None):
+            notes += self.uncategorized_notes()
+        return notes
+
+    def resolve_category(self, cat):
+        """Returns the id of the category whose properties apply to cat"""
         if ((not cat) or (not cat in self.categories)) and \
                 self.properties.get("default_cat", None):
             cat = self.properties["default_cat"]
-        cat_data = self.categories.get(cat, {})
+        return cat
+
+    def get_category_property(self, cat, prop):
+        """Get a property of a category or the default"""
+        try:
+            return self._category_cache[cat, prop]
+        except KeyError:
+            pass
+        rcat = self.resolve_category(cat)
+        cat_data = self.categories.get(rcat, {})
         if prop in cat_data:
-            return cat_data[prop]
+            value = cat_data[prop]
         # Otherwise, use fallback categories
-        if prop in FALLBACK_PROPERTIES:
-            return FALLBACK_PROPERTIES[prop]
+        elif prop in FALLBACK_PROPERTIES:
+            value = FALLBACK_PROPERTIES[prop]
         else:
             raise ValueError("Unknown property")
+        self._category_cache[cat, prop] = value
+        return value
+
+    def invalidate_categories(self):
+        """Forgets resolved category properties after categories changed"""
+        self._category_cache.clear()
+        self.categories_version += 1
+
+    def set_category_property(self, cat, prop, value):
+        """Sets a property (e.g. name or bgcolor_hsv) of a category"""
+        self.categories[cat][prop] = value
+        self.invalidate_categories()
+
+    def new_category(self):
+        """Creates an empty category and returns its id"""
+        cid = str(uuid.uuid4())
+        self.categories[cid] = {}
+        self.invalidate_categories()
+        return cid
+
+    def delete_category(self, cat):
+        """Deletes a category; its notes fall back to the default"""
+        del self.categories[cat]
+        self.invalidate_categories()
+
+    def set_default_category(self, cat):
+        self.properties["default_cat"] = cat
+        self.invalidate_categories()
+
+# uuids of the notes in each outcome of a merge. Conflicting notes were
+# changed locally at least as recently as in the merged data, so they were
+# kept as they are. Notes that could not be read are Malformed entries.
+MergeReport = namedtuple("MergeReport",
+        ["added", "updated", "unchanged", "conflicts", "malformed"])
+
+def _stored_properties(properties):
+    """Returns note properties as Note.properties would return them"""
+    properties = dict(properties)
+    for prop in ("position", "size"):
+        if properties.get(prop) is not None:
+            properties[prop] = tuple(properties[prop])
+    return properties
+
+class Merge:
+    """Merges notes and categories into a NoteSet one at a time
+
+    Merged notes are matched to existing ones by uuid and only replace them
+    if they were modified more recently. Once the merge is finished, only
+    the notes that were added or changed are shown or reloaded, and only
+    the open windows of notes whose category changed are restyled.
+    Unsaved edits in note windows are taken into account as local
+    changes."""
+    def __init__(self, noteset):
+        self.noteset = noteset
+        self.report = MergeReport([], [], [], [], [])
+        # Number of members fed so far
+        self.read = 0
+        # Notes to show or reload, and notes to restyle (as keys of dicts)
+        self._changed = {}
+        self._restyled = {}
+        self._categories_changed = False
+        # Merged notes -> categories they refer to that did not exist (yet),
+        # since exports list categories after notes
+        self._missing_categories = {}
+
+    def categories(self, categories):
+        """Adds or replaces categories"""
+        changed = [cid for cid, cdata in categories.items()
+                if self.noteset.categories.get(cid) != cdata]
+        if not changed:
+            return
+        self._categories_changed = True
+        for cid in changed:
+            self.noteset.categories[cid] = categories[cid]
+        self.noteset.invalidate_categories()
+        for note, cat in list(self._missing_categories.items()):
+            if cat in self.noteset.categories:
+                del self._missing_categories[note]
+                if self._deleted(note):
+                    continue
+                note.category = cat
+                note.mark_dirty()
+        for cid in changed:
+            self._restyled.update(dict.fromkeys(
+                self.noteset.styled_notes(cid)))
+
+    def feed(self, key, value):
+        """Merges a member of an export, as yielded by parse_export"""
+        self.read += 1
+        if key == "notes":
+            if isinstance(value, Malformed):
+                self.report.malformed.append(value)
+            else:
+                self.note(value)
+        elif key == "categories" and isinstance(value, dict):
+            self.categories(value)
+
+    def broken_off(self, error):
+        """Records that an export could not be parsed any further
+
+        The error is raised again if nothing at all could be read."""
+        if not self.read:
+            raise error
+        self.report.malformed.append(Malformed(None, str(error)))
+
+    def note(self, newnote):
+        """Merges a note, given as a dictionary in the exported format"""
+        note = self.noteset.find(newnote.get("uuid"))
+        if note is None:
+            # Note() makes up a uuid if there is none
+            note = Note(newnote, noteset=self.noteset)
+            self.noteset.add(note)
+            note.mark_dirty()
+            self._changed[note] = None
+            self.report.added.append(note.uuid)
+            if note.category != newnote.get("cat", ""):
+                self._missing_categories[note] = newnote["cat"]
+            return
+        if note.dirty and not note in self._changed:
+            # Edits not saved yet count as local changes
+            note.update_from_gui()
+        last_modified = newnote.get("last_modified") or ""
+        local_modified = note.last_modified_str
+        if last_modified < local_modified:
+            self.report.conflicts.append(note.uuid)
+            return
+        newcategory = newnote.get("cat", note.category)
+        category = newcategory
+        if not category in self.noteset.categories:
+            category = ""
+        properties = note.properties
+        if "properties" in newnote:
+            newproperties = _stored_properties(newnote["properties"])
+        else:
+            newproperties = properties
+        if last_modified == local_modified:
+            # The body only changes along with last_modified
+            if newcategory == note.category and newproperties == properties:
+                self.report.unchanged.append(note.uuid)
+            else:
+                self.report.conflicts.append(note.uuid)
+            return
+        if "body" in newnote:
+            note.body = newnote["body"]
+        note.properties = newproperties
+        if category != note.category:
+            note.category = category
+        if category != newcategory:
+            self._missing_categories[note] = newcategory
+        note.last_modified = last_modified
+        note.mark_dirty()
+        self._changed[note] = None
+        self.report.updated.append(note.uuid)
+
+    def _deleted(self, note):
+        """Whether a note was deleted while the merge was running (e.g. by
+        the user during a background import)"""
+        return self.noteset.find(note.uuid) is not note
+
+    def finish(self):
+        """Updates the affected windows and saves; returns the MergeReport"""
+        for note in self._changed:
+            if self._deleted(note):
+                continue
+            if note.gui == None:
+                note.show()
+            else:
+                note.show(reload_from_backend=True)
+        for note in self._restyled:
+            # Reloading would discard unsaved edits in the window
+            if note.gui != None and not note in self._changed and \
+                    not self._deleted(note):
+                note.gui.update_style()
+                note.gui.update_font()
+        if self._changed or self._restyled or self._categories_changed:
+            self.noteset.request_save()
+        return self.report
 
 class dGUI:
     """Dummy GUI"""
-    def __init__(self, *args, **kwargs):
-        pass
-    def show(self):
+    def __init__(self, note=None, *args, **kwargs):
+        self.note = note
+    def show(self, *args, **kwargs):
         pass
     def hide(self):
         pass
     def update_note(self):
         pass
     def properties(self):
-        return None
+        # There is no window to move, so the note stays where it was
+        return self.note.properties if self.note else None
+    def update_style(self):
+        pass
+    def update_font(self):
+        pass
 
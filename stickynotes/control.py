@@ -0,0 +1,214 @@
+# Copyright © 2012-2018 Umang Varma <umang.me@gmail.com>
+#
+# This file is part of indicator-stickynotes.
+#
+# indicator-stickynotes is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# indicator-stickynotes is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# indicator-stickynotes.  If not, see <http://www.gnu.org/licenses/>.
+
+# Requests to the running instance. A client connects to CONTROL_ADDRESS and
+# sends one line of JSON, an object whose "command" member is one of
+# "new-note" (with "body"), "show-all", "hide-all", "search" (with "query"),
+# "export" (with "path") or "import" (with "paths"). The instance answers
+# with one line of JSON, an object whose "ok" member tells whether the
+# request succeeded; otherwise "error" says why. Search results are in
+# "notes", a list of objects with "uuid" and "body".
+#
+# The socket is reachable by every local user, so both ends check that the
+# other one belongs to the same user.
+#
+# This module is used before GTK is loaded, so it must not import it.
+
+import argparse
+import json
+import os
+import socket
+import struct
+import sys
+from locale import gettext as _
+
+# Abstract socket, next to the one that only serves as lock
+CONTROL_ADDRESS = "\0indicator-stickynotes-control"
+# Longest request accepted, in bytes
+MAX_REQUEST = 1024 * 1024
+
+def add_arguments(parser):
+    """Adds the command line options that make requests"""
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--new-note", nargs="?", const="", metavar="TEXT",
+            help=_("create a note, with the given text"))
+    group.add_argument("--show-all", action="store_true",
+            help=_("show all notes"))
+    group.add_argument("--hide-all", action="store_true",
+            help=_("hide all notes"))
+    group.add_argument("--search", metavar="QUERY",
+            help=_("list the notes containing every word of the query"))
+    group.add_argument("--export", metavar="FILE",
+            help=_("export all notes to a file"))
+    group.add_argument("--import", dest="import_paths", nargs="+",
+            metavar="PATH", help=_("import exported files, or folders of "
+                "them"))
+
+def request_from_args(args):
+    """Returns the request made on the command line, or None"""
+    if args.new_note is not None:
+        return {"command": "new-note", "body": args.new_note}
+    if args.show_all:
+        return {"command": "show-all"}
+    if args.hide_all:
+        return {"command": "hide-all"}
+    if args.search is not None:
+        return {"command": "search", "query": args.search}
+    if args.export:
+        return {"command": "export", "path": os.path.abspath(args.export)}
+    if args.import_paths:
+        return {"command": "import",
+                "paths": [os.path.abspath(p) for p in args.import_paths]}
+    return None
+
+def peer_uid(sock):
+    """Returns the user id of the process at the other end of sock"""
+    credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+            struct.calcsize("3i"))
+    pid, uid, gid = struct.unpack("3i", credentials)
+    return uid
+
+def send_request(request, address=CONTROL_ADDRESS):
+    """Sends a request to the running instance and returns its response
+
+    Returns None if no instance of the current user is listening. If
+    request is None, only checks for an instance and returns an empty
+    dictionary."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with sock:
+        try:
+            sock.connect(address)
+        except (ConnectionRefusedError, FileNotFoundError):
+            return None
+        if peer_uid(sock) != os.getuid():
+            return None
+        if request is None:
+            return {}
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        data = b""
+        while not b"\n" in data:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    try:
+        return json.loads(data.decode("utf-8"))
+    except ValueError:
+        return {"ok": False, "error": "Malformed response"}
+
+def print_response(response):
+    """Prints the outcome of a request for the command line"""
+    if not response.get("ok"):
+        print(response.get("error", _("Request failed")), file=sys.stderr)
+    for note in response.get("notes", []):
+        lines = note["body"].splitlines()
+        print(note["uuid"], lines[0] if lines else "")
+
+def forward(argv):
+    """Hands the request on the command line to a running instance
+
+    Exits once the instance has answered; returns if there is no instance,
+    or if the command line has to be checked by the full parser."""
+    parser = argparse.ArgumentParser(add_help=False, exit_on_error=False)
+    add_arguments(parser)
+    try:
+        args, rest = parser.parse_known_args(argv)
+    except argparse.ArgumentError:
+        return
+    if "-h" in rest or "--help" in rest:
+        return
+    request = request_from_args(args)
+    response = send_request(request)
+    if response is None:
+        return
+    if request is None:
+        print('Indicator stickynotes already running.')
+        sys.exit()
+    print_response(response)
+    sys.exit(0 if response.get("ok") else 1)
+
+class ControlServer:
+    """Accepts requests to the running instance from processes of the same
+    user
+
+    Every request is passed to handler(request, reply), which has to call
+    reply(response) once it is done. watch(fd, callback) has to call
+    callback() on the main loop whenever fd is readable, for as long as
+    callback returns True."""
+    def __init__(self, handler, watch, address=CONTROL_ADDRESS):
+        self.handler = handler
+        self.watch = watch
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(address)
+        self.sock.listen(8)
+        self.sock.setblocking(False)
+        watch(self.sock.fileno(), self._accept)
+
+    def close(self):
+        self.sock.close()
+
+    def _accept(self):
+        try:
+            conn, addr = self.sock.accept()
+        except BlockingIOError:
+            return True
+        except OSError:
+            # The socket has been closed
+            return False
+        if peer_uid(conn) != os.getuid():
+            conn.close()
+            return True
+        conn.setblocking(False)
+        data = []
+        def _read():
+            try:
+                chunk = conn.recv(65536)
+            except BlockingIOError:
+                return True
+            except OSError:
+                conn.close()
+                return False
+            data.append(chunk)
+            line = b"".join(data)
+            if chunk and not b"\n" in chunk and len(line) < MAX_REQUEST:
+                return True
+            if not line:
+                # Only checking whether an instance is running
+                conn.close()
+                return False
+            try:
+                request = json.loads(line.split(b"\n", 1)[0].decode("utf-8"))
+                if not isinstance(request, dict):
+                    raise ValueError()
+            except ValueError:
+                self._reply(conn, {"ok": False,
+                    "error": "Malformed request"})
+                return False
+            self.handler(request, lambda response: self._reply(conn,
+                response))
+            return False
+        self.watch(conn.fileno(), _read)
+        return True
+
+    def _reply(self, conn, response):
+        try:
+            conn.settimeout(1)
+            conn.sendall(json.dumps(response).encode("utf-8") + b"\n")
+        except OSError:
+            pass
+        finally:
+            conn.close()
@@ -15,53 +15,364 @@
 # You should have received a copy of the GNU General Public License along with
 # indicator-stickynotes.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import namedtuple
 from datetime import datetime
 from string import Template
 import gi
 gi.require_version("Gtk", "3.0")
 gi.require_version("GtkSource", "3.0")
-from gi.repository import Gtk, Gdk, Gio, GObject, GtkSource, Pango
+gi.require_version("GdkPixbuf", "2.0")
+from gi.repository import Gtk, Gdk, GdkPixbuf, Gio, GLib, GObject, GtkSource, \
+        Pango
 from locale import gettext as _
 import os.path
 import colorsys
-import uuid
+from xml.sax.saxutils import escape
 
-def load_global_css():
-    """Adds a provider for the global CSS"""
-    global_css = Gtk.CssProvider()
-    global_css.load_from_path(os.path.join(os.path.dirname(__file__), "..",
-        "style_global.css"))
+from stickynotes.info import SAVE_DELAY, REBUILD_ON_SHOW, WINDOW_POOL_SIZE, \
+        RESOURCE_FILE, RESOURCE_PREFIX
+
+def asset_path(filename):
+    """Returns the path of one of the files installed next to the package"""
+    return os.path.abspath(os.path.join(os.path.dirname(__file__), "..",
+        filename))
+
+def register_resources():
+    """Registers the compiled resource bundle, if it has been built
+
+    The bundle is mapped into memory, so all UI files, stylesheets and
+    icons are then read without opening any further files."""
+    try:
+        resource = Gio.Resource.load(asset_path(RESOURCE_FILE))
+    except GLib.Error:
+        # Running from a source tree; fall back to the separate files
+        return False
+    Gio.resources_register(resource)
+    return True
+
+have_resources = register_resources()
+
+def read_asset(filename):
+    """Returns the text of a UI file or stylesheet"""
+    if have_resources:
+        return Gio.resources_lookup_data(RESOURCE_PREFIX + filename,
+                Gio.ResourceLookupFlags.NONE).get_data().decode("utf-8")
+    with open(asset_path(filename), encoding="utf-8") as fsock:
+        return fsock.read()
+
+# UI files are read once per process; see ui_definition
+_ui_definitions = {}
+
+def ui_definition(filename):
+    """Returns the contents of one of the UI files, reading it only once
+
+    Gtk.Builder resolves relative image paths against the UI file, which it
+    cannot do when loading from a string, so those are made absolute."""
+    if not filename in _ui_definitions:
+        icons = escape(os.path.join(asset_path("Icons"), ""))
+        _ui_definitions[filename] = read_asset(filename).replace(">Icons/",
+                ">" + icons)
+    return _ui_definitions[filename]
+
+def load_ui(builder, filename, objects=None):
+    """Adds the objects of one of the UI files (or only those named in
+    objects) to a Gtk.Builder"""
+    if have_resources:
+        if objects:
+            builder.add_objects_from_resource(RESOURCE_PREFIX + filename,
+                    objects)
+        else:
+            builder.add_from_resource(RESOURCE_PREFIX + filename)
+    elif objects:
+        builder.add_objects_from_string(ui_definition(filename), objects)
+    else:
+        builder.add_from_string(ui_definition(filename))
+
+def rebuild_on_show():
+    """Whether note windows have to be rebuilt every time they are shown"""
+    if REBUILD_ON_SHOW is not None:
+        return REBUILD_ON_SHOW
+    return "unity" in os.environ.get("XDG_CURRENT_DESKTOP", "").lower()
+
+# Style providers added through the functions below and not removed yet:
+# those on the default screen, those created for categories and how many
+# times these are attached to style contexts. See count_style_providers.
+provider_counts = {"screen": 0, "category": 0, "attached": 0}
+
+def add_screen_provider(provider):
+    """Adds a style provider to the default screen"""
     Gtk.StyleContext.add_provider_for_screen(Gdk.Screen.get_default(),
-            global_css, Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION)
+            provider, Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION)
+    provider_counts["screen"] += 1
+
+def add_context_provider(context, provider):
+    """Attaches a style provider to the style context of a widget"""
+    context.add_provider(provider, Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION)
+    provider_counts["attached"] += 1
+
+def remove_context_provider(context, provider):
+    """Detaches a style provider added with add_context_provider"""
+    context.remove_provider(provider)
+    provider_counts["attached"] -= 1
+
+# The provider of the global CSS, once it has been added to the screen
+global_css = None
+
+def load_global_css():
+    """(Re)loads the global CSS
+
+    There is a single provider for it, which is added to the screen the
+    first time and reloaded in place afterwards."""
+    global global_css
+    if global_css is None:
+        global_css = Gtk.CssProvider()
+        add_screen_provider(global_css)
+    if have_resources:
+        global_css.load_from_resource(RESOURCE_PREFIX + "style_global.css")
+    else:
+        global_css.load_from_path(asset_path("style_global.css"))
+
+def count_style_providers():
+    """Returns how many style providers have been added
+
+    The result is a dict with the number of providers added to the screen,
+    the number of providers created for categories and the number of times
+    those are attached to the widgets of note windows, as counted by the
+    functions that do so. The first two should stay bounded by the number
+    of categories and the last by twice the number of note windows,
+    however long the program runs."""
+    return dict(provider_counts)
+
+class SaveScheduler:
+    """Coalesces the save requests of a NoteSet on the GLib main loop
+
+    A request starts a timer of delay milliseconds and any requests made
+    before it fires are served by the same save."""
+    def __init__(self, noteset, delay=SAVE_DELAY):
+        self.noteset = noteset
+        self.delay = delay
+        self._source = None
+
+    def request(self):
+        """Schedules a save unless one is already pending"""
+        if self._source is None:
+            self._source = GLib.timeout_add(self.delay, self._timeout)
+
+    def _timeout(self):
+        self._source = None
+        self.noteset.save()
+        return False
+
+    def flush(self):
+        """Cancels the timer and saves immediately"""
+        if self._source is not None:
+            GLib.source_remove(self._source)
+            self._source = None
+        self.noteset.save()
+
+class WindowPool:
+    """Keeps a few parsed note windows ready to be connected and shown
+
+    Windows are replenished from idle callbacks, so rebuilding a note's
+    window does not have to parse its UI definition."""
+    def __init__(self, size):
+        self.size = size
+        self._builders = []
+        self._source = None
+
+    def take(self):
+        """Returns a Gtk.Builder holding a new, unconnected note window"""
+        builder = self._builders.pop() if self._builders else self._new()
+        if self._source is None and len(self._builders) < self.size:
+            self._source = GLib.idle_add(self._fill)
+        return builder
+
+    def _new(self):
+        builder = Gtk.Builder()
+        load_ui(builder, "StickyNotes.ui")
+        return builder
+
+    def _fill(self):
+        self._builders.append(self._new())
+        if len(self._builders) < self.size:
+            return True
+        self._source = None
+        return False
+
+# The note UI refers to GtkSourceView, which Gtk.Builder must know about
+GObject.type_register(GtkSource.View)
+window_pool = WindowPool(WINDOW_POOL_SIZE if rebuild_on_show() else 0)
+
+def css_data(noteset, cat):
+    """Returns data to substitute into the CSS template for a category"""
+    data = {}
+    # Converts to RGB hex. All RGB/HSV values are scaled to a max of 1
+    rgb_to_hex = lambda x: "#" + "".join(["{:02x}".format(int(255*a))
+        for a in x])
+    hsv_to_hex = lambda x: rgb_to_hex(colorsys.hsv_to_rgb(*x))
+    data["bgcolor_hex"] = hsv_to_hex(
+            noteset.get_category_property(cat, "bgcolor_hsv"))
+    data["text_color"] = rgb_to_hex(
+            noteset.get_category_property(cat, "textcolor"))
+    return data
+
+# Decoded button icons, shared by all notes; see icon_pixbuf
+_icon_pixbufs = {}
+
+def icon_pixbuf(name, dark=False):
+    """Returns the GdkPixbuf of a button icon, decoding it only once"""
+    filename = name + ("-dark" if dark else "") + ".png"
+    if not filename in _icon_pixbufs:
+        if have_resources:
+            _icon_pixbufs[filename] = GdkPixbuf.Pixbuf.new_from_resource(
+                    RESOURCE_PREFIX + "Icons/" + filename)
+        else:
+            _icon_pixbufs[filename] = GdkPixbuf.Pixbuf.new_from_file(
+                    asset_path(os.path.join("Icons", filename)))
+    return _icon_pixbufs[filename]
+
+def use_dark_icons(bgcolor_hsv):
+    """Whether button icons on a background need to be dark"""
+    h,s,v = bgcolor_hsv
+    # an arbitrary quadratic found by trial and error
+    thresh_sat = 1.05 - 1.7*((v-1)**2)
+    return s >= thresh_sat
+
+# Everything a note window needs to look like its category
+CategoryStyle = namedtuple("CategoryStyle", ["css", "dark_icons", "font"])
+
+class StyleCache:
+    """Resolved styles of every category, shared by all notes in it
+
+    Styles are only recomputed after the NoteSet's categories changed. A
+    category's Gtk.CssProvider is recompiled in place when its colors
+    change, so the notes using it pick up the new style without being
+    touched."""
+    def __init__(self):
+        self._template = None
+        self._version = None
+        # Resolved category id -> CategoryStyle
+        self._styles = {}
+        # Resolved category id -> (CSS data, Gtk.CssProvider)
+        self._providers = {}
+
+    def style(self, noteset, cat):
+        """Returns the CategoryStyle of a category"""
+        if self._version != noteset.categories_version:
+            self._styles = {}
+            self._version = noteset.categories_version
+        cat = noteset.resolve_category(cat)
+        if not cat in self._styles:
+            self._styles[cat] = CategoryStyle(self.provider(noteset, cat),
+                    use_dark_icons(noteset.get_category_property(cat,
+                        "bgcolor_hsv")),
+                    Pango.FontDescription.from_string(
+                        noteset.get_category_property(cat, "font")))
+        return self._styles[cat]
+
+    def provider(self, noteset, cat):
+        """Returns the up-to-date Gtk.CssProvider for a category"""
+        if self._template is None:
+            self._template = Template(read_asset("style.css"))
+        data = css_data(noteset, cat)
+        olddata, provider = self._providers.get(cat, (None, None))
+        if data != olddata:
+            if provider is None:
+                provider = Gtk.CssProvider()
+                provider_counts["category"] += 1
+            provider.load_from_data(self._template.substitute(**data)\
+                    .encode("ascii", "replace"))
+            self._providers[cat] = (data, provider)
+        return provider
+
+style_cache = StyleCache()
+
+class CategoryMenu:
+    """The menu model shared by the menus of all note windows
+
+    Each note window only provides the "note" actions the menu refers to;
+    the category entries are kept in line with the NoteSet's categories in
+    this one model."""
+    def __init__(self):
+        self.model = None
+        self._section = None
+        self._version = None
+        # (category id, name) of every entry in the categories section
+        self._entries = []
+
+    def get_model(self, noteset):
+        """Returns the menu model, creating it the first time"""
+        if self.model is None:
+            self.model = Gio.Menu()
+            self.model.append(_("Always on top"), "note.always-on-top")
+            self.model.append(_("Settings"), "note.settings")
+            self._section = Gio.Menu()
+            self.model.append_section(_("Categories:"), self._section)
+        self.update(noteset)
+        return self.model
+
+    def update(self, noteset):
+        """Updates the category entries after categories changed
+
+        Only entries which were renamed, added or moved are replaced."""
+        if self._section is None or \
+                self._version == noteset.categories_version:
+            return
+        self._version = noteset.categories_version
+        entries = [(cid, cdata.get("name", _("New Category"))) for cid,
+                cdata in noteset.categories.items()]
+        for i, (cid, name) in enumerate(entries):
+            if i < len(self._entries):
+                if self._entries[i] == (cid, name):
+                    continue
+                self._section.remove(i)
+            item = Gio.MenuItem.new(name, None)
+            item.set_action_and_target_value("note.category",
+                    GLib.Variant.new_string(cid))
+            self._section.insert_item(i, item)
+        for i in reversed(range(len(entries), len(self._entries))):
+            self._section.remove(i)
+        self._entries = entries
+
+category_menu = CategoryMenu()
 
 class StickyNote:
     """Manages the GUI of an individual stickynote"""
     def __init__(self, note):
         """Initializes the stickynotes window"""
-        self.path = os.path.abspath(os.path.join(os.path.dirname(__file__),
-            '..'))
         self.note = note
         self.noteset = note.noteset
-        self.locked = self.note.properties.get("locked", False)
+        self.locked = bool(self.note.locked)
 
         # Create menu
-        self.menu = Gtk.Menu()
-        self.populate_menu()
-
-        # Load CSS template and initialize Gtk.CssProvider
-        with open(os.path.join(self.path, "style.css"), encoding="utf-8") \
-                as css_file:
-            self.css_template = Template(css_file.read())
-        self.css = Gtk.CssProvider()
+        self.actions = Gio.SimpleActionGroup()
+        aot = Gio.SimpleAction.new_stateful("always-on-top", None,
+                GLib.Variant.new_boolean(False))
+        aot.connect("change-state", self.malways_on_top_toggled)
+        self.actions.add_action(aot)
+        mset = Gio.SimpleAction.new("settings", None)
+        mset.connect("activate", self.noteset.indicator.show_settings)
+        self.actions.add_action(mset)
+        mcat = Gio.SimpleAction.new_stateful("category",
+                GLib.VariantType.new("s"),
+                GLib.Variant.new_string(self.note.category or ""))
+        mcat.connect("change-state", self.category_selected)
+        self.actions.add_action(mcat)
+        self.menu = Gtk.Menu.new_from_model(
+                category_menu.get_model(self.noteset))
+        self.menu.insert_action_group("note", self.actions)
+
+        # The category's CSS provider currently applied to the window
+        self.css = None
+        # Whether the window currently shows dark icons
+        self.dark_icons = None
 
         self.build_note()
         
     def build_note(self):
-        self.builder = Gtk.Builder()
-        GObject.type_register(GtkSource.View)
-        self.builder.add_from_file(os.path.join(self.path,
-            "StickyNotes.ui"))
+        self.builder = window_pool.take()
         self.builder.connect_signals(self)
+        self.dark_icons = None
         self.winMain = self.builder.get_object("MainWindow")
 
         # Get necessary objects
@@ -85,12 +396,13 @@ class StickyNote:
         self.bbody.set_highlight_matching_brackets(False)
         self.bbody.end_not_undoable_action()
         self.txtNote.set_buffer(self.bbody)
+        self.bbody.connect("changed", self.text_changed)
         # Make resize work
         self.winMain.add_events(Gdk.EventMask.BUTTON_PRESS_MASK)
         self.eResizeR.add_events(Gdk.EventMask.BUTTON_PRESS_MASK)
         # Move Window
-        self.winMain.move(*self.note.properties.get("position", (10,10)))
-        self.winMain.resize(*self.note.properties.get("size", (200,150)))
+        self.winMain.move(*(self.note.position or (10, 10)))
+        self.winMain.resize(*(self.note.size or (200, 150)))
         # Show the window
         self.winMain.set_skip_pager_hint(True)
         self.winMain.show_all()
@@ -100,7 +412,10 @@ class StickyNote:
                     Gdk.CursorType.BOTTOM_RIGHT_CORNER))
         # Set locked state
         self.set_locked_state(self.locked)
+        self.raise_note()
 
+    def raise_note(self):
+        """Brings the window above other windows"""
         # call set_keep_above just to have the note appearing
         # above everything else.
         # without it, it still won't appear above a window
@@ -120,28 +435,75 @@ class StickyNote:
     # (property necessary to prevent sticky note from showing on the taskbar)
 
     # workaround which is based on deleting a sticky note and re-initializing
-    # it. 
+    # it. It is only used where needed (see rebuild_on_show); elsewhere the
+    # existing window is presented again.
     def show(self, widget=None, event=None, reload_from_backend=False):
         """Shows the stickynotes window"""
 
-        # don't overwrite settings if loading from backend
-        if not reload_from_backend:
-            # store sticky note's settings
+        if not reload_from_backend and self.note.dirty:
+            # store sticky note's settings, including a move that has not
+            # been saved yet, so the window is not put back where it was
             self.update_note()
-        else:
-            # Categories may have changed in backend
-            self.populate_menu()
-
-        # destroy its main window
-        self.winMain.destroy()
+            self.note.properties = self.properties()
 
-        # reinitialize that window
-        self.build_note()
+        if reload_from_backend:
+            # Categories may have changed in backend
+            category_menu.update(self.noteset)
+            self.actions.lookup_action("category").set_state(
+                    GLib.Variant.new_string(self.note.category or ""))
+        elif not rebuild_on_show():
+            self.winMain.show()
+            self.winMain.move(*(self.note.position or (10, 10)))
+            self.raise_note()
+            return
+
+        if rebuild_on_show():
+            # destroy its main window
+            self.destroy_window()
+            # reinitialize that window
+            self.build_note()
+        else:
+            self.reload()
+
+    def reload(self):
+        """Updates the existing window from the underlying note"""
+        if self.bbody.get_text(self.bbody.get_start_iter(),
+                self.bbody.get_end_iter(), True) != self.note.body:
+            self.bbody.begin_not_undoable_action()
+            self.bbody.set_text(self.note.body)
+            self.bbody.end_not_undoable_action()
+        self.update_style()
+        self.update_font()
+        self.winMain.show()
+        self.winMain.move(*(self.note.position or (10, 10)))
+        self.winMain.resize(*(self.note.size or (200, 150)))
+        self.set_locked_state(bool(self.note.locked))
+        self.raise_note()
 
     def hide(self, *args):
         """Hides the stickynotes window"""
+        # Hidden windows no longer report where they are, so store any
+        # unsaved move or resize first
+        if self.note.dirty:
+            self.update_note()
+            self.note.properties = self.properties()
         self.winMain.hide()
 
+    def text_changed(self, *args):
+        """Action when the note's text is edited"""
+        self.note.mark_dirty()
+        self.noteset.body_changed(self.note)
+
+    def configure(self, *args):
+        """Action when the window is moved or resized"""
+        if not self.note.dirty:
+            position = self.note.position or (10, 10)
+            size = self.note.size or (200, 150)
+            if self.winMain.get_position() != position or \
+                    self.winMain.get_size() != size:
+                self.note.mark_dirty()
+        return False
+
     def update_note(self):
         """Update the underlying note object"""
         self.note.update(self.bbody.get_text(self.bbody.get_start_iter(),
@@ -164,97 +526,58 @@ class StickyNote:
         prop = {"position":self.winMain.get_position(),
                 "size":self.winMain.get_size(), "locked":self.locked}
         if not self.winMain.get_visible():
-            prop["position"] = self.note.properties.get("position", (10, 10))
-            prop["size"] = self.note.properties.get("size", (200, 150))
+            prop["position"] = self.note.position or (10, 10)
+            prop["size"] = self.note.size or (200, 150)
         return prop
 
     def update_font(self):
         """Updates the font"""
         # Unset any previously set font
         self.txtNote.override_font(None)
-        font = Pango.FontDescription.from_string(
-                self.note.cat_prop("font"))
-        self.txtNote.override_font(font)
+        self.txtNote.override_font(
+                style_cache.style(self.noteset, self.note.category).font)
 
     def update_style(self):
-        """Updates the style using CSS template"""
+        """Applies the style of the note's category"""
         self.update_button_color()
-        css_string = self.css_template.substitute(**self.css_data())\
-                .encode("ascii", "replace")
-        self.css.load_from_data(css_string)
+        css = style_cache.style(self.noteset, self.note.category).css
+        if css is self.css:
+            return
         for context in self.style_contexts:
-            context.add_provider(self.css,
-                    Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION)
+            if self.css is not None:
+                remove_context_provider(context, self.css)
+            add_context_provider(context, css)
+        self.css = css
+
+    def destroy_window(self):
+        """Destroys the window, detaching the style of its category"""
+        if self.css is not None:
+            for context in self.style_contexts:
+                remove_context_provider(context, self.css)
+            self.css = None
+        self.winMain.destroy()
 
     def update_button_color(self):
         """Switches between regular and dark icons appropriately"""
-        h,s,v = self.note.cat_prop("bgcolor_hsv")
-        # an arbitrary quadratic found by trial and error
-        thresh_sat = 1.05 - 1.7*((v-1)**2)
-        suffix = "-dark" if s >= thresh_sat else ""
+        dark = style_cache.style(self.noteset, self.note.category).dark_icons
+        if dark == self.dark_icons:
+            return
         iconfiles = {"imgAdd":"add", "imgClose":"close", "imgDropdown":"menu",
                 "imgLock":"lock", "imgUnlock":"unlock", "imgResizeR":"resizer"}
         for img, filename in iconfiles.items():
-            getattr(self, img).set_from_file(
-                    os.path.join(os.path.dirname(__file__), "..","Icons/" +
-                    filename + suffix + ".png"))
-
-    def css_data(self):
-        """Returns data to substitute into the CSS template"""
-        data = {}
-        # Converts to RGB hex. All RGB/HSV values are scaled to a max of 1
-        rgb_to_hex = lambda x: "#" + "".join(["{:02x}".format(int(255*a))
-            for a in x])
-        hsv_to_hex = lambda x: rgb_to_hex(colorsys.hsv_to_rgb(*x))
-        bgcolor_hsv = self.note.cat_prop("bgcolor_hsv")
-        data["bgcolor_hex"] = hsv_to_hex(
-                self.note.cat_prop("bgcolor_hsv"))
-        data["text_color"] = rgb_to_hex(self.note.cat_prop("textcolor"))
-        return data
-
-    def populate_menu(self):
-        """(Re)populates the note's menu items appropriately"""
-        def _delete_menu_item(item, *args):
-            self.menu.remove(item)
-        self.menu.foreach(_delete_menu_item, None)
-
-        aot = Gtk.CheckMenuItem.new_with_label(_("Always on top"))
-        aot.connect("toggled", self.malways_on_top_toggled)
-        self.menu.append(aot)
-        aot.show()
-
-        mset = Gtk.MenuItem(_("Settings"))
-        mset.connect("activate", self.noteset.indicator.show_settings)
-        self.menu.append(mset)
-        mset.show()
-
-        sep = Gtk.SeparatorMenuItem()
-        self.menu.append(sep)
-        sep.show()
-
-        catgroup = []
-        mcats = Gtk.RadioMenuItem.new_with_label(catgroup,
-                _("Categories:"))
-        self.menu.append(mcats)
-        mcats.set_sensitive(False)
-        catgroup = mcats.get_group()
-        mcats.show()
-
-        for cid, cdata in self.noteset.categories.items():
-            mitem = Gtk.RadioMenuItem.new_with_label(catgroup,
-                    cdata.get("name", _("New Category")))
-            catgroup = mitem.get_group()
-            if cid == self.note.category:
-                mitem.set_active(True)
-            mitem.connect("activate", self.set_category, cid)
-            self.menu.append(mitem)
-            mitem.show()
-
-    def malways_on_top_toggled(self, widget, *args):
-        self.winMain.set_keep_above(widget.get_active())
+            getattr(self, img).set_from_pixbuf(icon_pixbuf(filename, dark))
+        self.dark_icons = dark
+
+    def malways_on_top_toggled(self, action, value):
+        action.set_state(value)
+        self.winMain.set_keep_above(value.get_boolean())
+
+    def category_selected(self, action, value):
+        """Action when a category is chosen in the note's menu"""
+        self.set_category(None, value.get_string())
 
     def save(self, *args):
-        self.note.noteset.save()
+        self.note.noteset.request_save()
         return False
 
     def add(self, *args):
@@ -262,10 +585,9 @@ class StickyNote:
 
         # Set the new note to the current category
         new_note.gui.set_category(None, self.note.category)
-        new_note.gui.populate_menu()  # Fix Category Menu Selected indicator
 
         # Set the new note position below this note
-        w, h = self.note.properties.get("position", (10, 10))
+        w, h = self.note.position or (10, 10)
         h += self.winMain.get_allocation().height + 10
         new_note.gui.winMain.move(w, h)
 
@@ -281,7 +603,7 @@ class StickyNote:
         winConfirm.destroy()
         if confirm == Gtk.ResponseType.ACCEPT:
             self.note.delete()
-            self.winMain.destroy()
+            self.destroy_window()
             return False
         else:
             return True
@@ -295,12 +617,18 @@ class StickyNote:
         """Set the note's category"""
         if not cat in self.noteset.categories:
             raise KeyError("No such category")
-        self.note.category = cat
+        if self.note.category != cat:
+            self.note.category = cat
+            self.note.mark_dirty()
+        self.actions.lookup_action("category").set_state(
+                GLib.Variant.new_string(cat))
         self.update_style()
         self.update_font()
 
     def set_locked_state(self, locked):
         """Change the locked state of the stickynote"""
+        if self.locked != locked:
+            self.note.mark_dirty()
         self.locked = locked
         self.txtNote.set_editable(not self.locked)
         self.txtNote.set_cursor_visible(not self.locked)
@@ -317,10 +645,8 @@ class StickyNote:
         self.save(*args)
 
 def show_about_dialog():
-    glade_file = os.path.abspath(os.path.join(os.path.dirname(__file__),
-            '..', "GlobalDialogs.ui"))
     builder = Gtk.Builder()
-    builder.add_from_file(glade_file)
+    load_ui(builder, "GlobalDialogs.ui")
     winAbout = builder.get_object("AboutWindow")
     ret =  winAbout.run()
     winAbout.destroy()
@@ -332,11 +658,10 @@ class SettingsCategory:
         self.settingsdialog = settingsdialog
         self.noteset = settingsdialog.noteset
         self.cat = cat
+        # Kinds of restyles waiting for the next frame; see queue_restyle
+        self.pending_restyle = set()
         self.builder = Gtk.Builder()
-        self.path = os.path.abspath(os.path.join(os.path.dirname(__file__),
-            '..'))
-        self.builder.add_objects_from_file(os.path.join(self.path,
-            "SettingsCategory.ui"), ["catExpander"])
+        load_ui(self.builder, "SettingsCategory.ui", ["catExpander"])
         self.builder.connect_signals(self)
         widgets = ["catExpander", "lExp", "cbBG", "cbText", "eName",
                 "confirmDelete", "fbFont"]
@@ -382,18 +707,20 @@ class SettingsCategory:
 
     def make_default(self, *args):
         """Make this the default category"""
-        self.noteset.properties["default_cat"] = self.cat
+        self.noteset.set_default_category(self.cat)
         self.settingsdialog.refresh_category_titles()
-        for note in self.noteset.notes:
-            note.gui.update_style()
-            note.gui.update_font()
+        # Only notes without a valid category follow the default
+        for note in self.noteset.uncategorized_notes():
+            if note.gui != None:
+                note.gui.update_style()
+                note.gui.update_font()
 
     def eName_changed(self, *args):
         """Update a category name"""
-        self.noteset.categories[self.cat]["name"] = self.eName.get_text()
+        self.noteset.set_category_property(self.cat, "name",
+                self.eName.get_text())
         self.refresh_title()
-        for note in self.noteset.notes:
-            note.gui.populate_menu()
+        category_menu.update(self.noteset)
 
     def update_bg(self, *args):
         """Action to update the background color"""
@@ -405,11 +732,8 @@ class SettingsCategory:
             # Some versions of GObjectIntrospection are affected by
             # https://bugzilla.gnome.org/show_bug.cgi?id=687633 
         hsv = colorsys.rgb_to_hsv(rgba.red, rgba.green, rgba.blue)
-        self.noteset.categories[self.cat]["bgcolor_hsv"] = hsv
-        for note in self.noteset.notes:
-            note.gui.update_style()
-        # Remind some widgets that they are transparent, etc.
-        load_global_css()
+        self.noteset.set_category_property(self.cat, "bgcolor_hsv", hsv)
+        self.queue_restyle("style")
 
     def update_textcolor(self, *args):
         """Action to update the text color"""
@@ -418,28 +742,96 @@ class SettingsCategory:
         except TypeError:
             rgba = Gdk.RGBA()
             self.cbText.get_rgba(rgba)
-        self.noteset.categories[self.cat]["textcolor"] = \
-                [rgba.red, rgba.green, rgba.blue]
-        for note in self.noteset.notes:
-            note.gui.update_style()
+        self.noteset.set_category_property(self.cat, "textcolor",
+                [rgba.red, rgba.green, rgba.blue])
+        self.queue_restyle("style")
 
     def update_font(self, *args):
         """Action to update the font size"""
-        self.noteset.categories[self.cat]["font"] = \
-            self.fbFont.get_font_name()
-        for note in self.noteset.notes:
-            note.gui.update_font()
+        self.noteset.set_category_property(self.cat, "font",
+                self.fbFont.get_font_name())
+        self.queue_restyle("font")
+
+    def queue_restyle(self, kind):
+        """Restyles the category's notes on the next frame
+
+        kind is "style" for colors or "font". Any number of changes made
+        before the next frame (e.g. while dragging a color picker) are
+        applied at once."""
+        if not self.pending_restyle:
+            self.settingsdialog.wSettings.add_tick_callback(
+                    self.apply_restyle)
+        self.pending_restyle.add(kind)
+
+    def apply_restyle(self, *args):
+        """Restyles the notes affected by pending changes"""
+        pending, self.pending_restyle = self.pending_restyle, set()
+        if pending:
+            for note in self.noteset.styled_notes(self.cat):
+                if note.gui == None:
+                    continue
+                if "style" in pending:
+                    note.gui.update_style()
+                if "font" in pending:
+                    note.gui.update_font()
+        return GLib.SOURCE_REMOVE
+
+class SearchDialog:
+    """Manages the search box, which shows only the notes matching it"""
+    def __init__(self, noteset):
+        self.noteset = noteset
+        # Notes shown because they matched the last query, or None before
+        # the first query
+        self.shown = None
+        self.wSearch = Gtk.Dialog(title=_("Search Notes"))
+        self.wSearch.add_buttons(Gtk.STOCK_CLOSE, Gtk.ResponseType.CLOSE)
+        self.wSearch.set_keep_above(True)
+        self.eSearch = Gtk.SearchEntry()
+        self.eSearch.connect("search-changed", self.search_changed)
+        self.lResults = Gtk.Label()
+        box = self.wSearch.get_content_area()
+        box.set_spacing(6)
+        box.pack_start(self.eSearch, False, False, 0)
+        box.pack_start(self.lResults, False, False, 0)
+        self.wSearch.connect("response", self.close)
+        self.wSearch.show_all()
+
+    def search_changed(self, *args):
+        """Shows the notes matching the query and hides the others"""
+        query = self.eSearch.get_text()
+        if not query.strip():
+            matches = []
+            self.lResults.set_text("")
+        else:
+            matches = self.noteset.search(query)
+            self.lResults.set_text(_("Matching notes: {0}").format(
+                len(matches)))
+        if self.shown is None:
+            if not matches:
+                return
+            self.noteset.hideall()
+            self.noteset.indicator.connect_secondary_activate()
+            self.shown = set()
+        for note in self.shown.difference(matches):
+            note.hide()
+        # Show the most recently modified notes last, so they end up on top
+        for note in reversed(matches):
+            note.show()
+        self.shown = set(matches)
+
+    def present(self):
+        self.wSearch.present()
+
+    def close(self, *args):
+        self.wSearch.destroy()
 
 class SettingsDialog:
     """Manages the GUI of the settings dialog"""
     def __init__(self, noteset):
         self.noteset = noteset
         self.categories = {}
-        self.path = os.path.abspath(os.path.join(os.path.dirname(__file__),
-            '..'))
-        glade_file = (os.path.join(self.path, "GlobalDialogs.ui"))
         self.builder = Gtk.Builder()
-        self.builder.add_from_file(glade_file)
+        load_ui(self.builder, "GlobalDialogs.ui")
         self.builder.connect_signals(self)
         widgets = ["wSettings", "boxCategories"]
         for w in widgets:
@@ -447,6 +839,9 @@ class SettingsDialog:
         for c in self.noteset.categories:
             self.add_category_widgets(c)
         ret =  self.wSettings.run()
+        # Don't lose restyles still waiting for a frame
+        for catsettings in self.categories.values():
+            catsettings.apply_restyle()
         self.wSettings.destroy()
 
     def add_category_widgets(self, cat):
@@ -457,19 +852,21 @@ class SettingsDialog:
 
     def new_category(self, *args):
         """Make a new category"""
-        cid = str(uuid.uuid4())
-        self.noteset.categories[cid] = {}
+        cid = self.noteset.new_category()
         self.add_category_widgets(cid)
+        category_menu.update(self.noteset)
 
     def delete_category(self, cat):
         """Delete a category"""
-        del self.noteset.categories[cat]
+        self.noteset.delete_category(cat)
         self.categories[cat].catExpander.destroy()
         del self.categories[cat]
-        for note in self.noteset.notes:
-            note.gui.populate_menu()
-            note.gui.update_style()
-            note.gui.update_font()
+        category_menu.update(self.noteset)
+        # The category's notes now fall back to the default category
+        for note in self.noteset.category_notes(cat):
+            if note.gui != None:
+                note.gui.update_style()
+                note.gui.update_font()
 
     def refresh_category_titles(self):
         for cid, catsettings in self.categories.items():
@@ -0,0 +1,292 @@
+# Copyright © 2012-2018 Umang Varma <umang.me@gmail.com>
+#
+# This file is part of indicator-stickynotes.
+#
+# indicator-stickynotes is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# indicator-stickynotes is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# indicator-stickynotes.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
+import os
+import re
+
+# Characters read from an export at a time
+CHUNK_SIZE = 64 * 1024
+
+# An entry of the notes array that could not be imported; index counts from 0
+Malformed = namedtuple("Malformed", ["index", "error"])
+
+# The contents of several exports. notes maps uuids (or, for notes without
+# one, unique tuples) to the most recently modified copy of each note. read
+# is the number of entries read from the files.
+BulkImport = namedtuple("BulkImport",
+        ["notes", "categories", "malformed", "read", "files"])
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r"\s*")
+_structural = re.compile(r'[\[\]{}",]')
+# The rest of a string after its opening quote
+_string_rest = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_timestamp = re.compile(r"\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\Z")
+
+def _element_end(text, pos):
+    """Returns where the array element starting at pos ends, i.e. the
+    position of the following "," or "]", or None if text ends first
+
+    Only strings and brackets are recognized, so this also finds the end of
+    most malformed elements."""
+    depth = 0
+    while True:
+        match = _structural.search(text, pos)
+        if match is None:
+            return None
+        char, pos = match.group(), match.end()
+        if char == '"':
+            match = _string_rest.match(text, pos)
+            if match is None:
+                return None
+            pos = match.end()
+        elif char in "[{":
+            depth += 1
+        elif char in "]}" and depth:
+            depth -= 1
+        elif depth == 0 and char != "}":
+            return match.start()
+
+class _Reader:
+    """Decodes JSON values from a file object, a chunk at a time"""
+    def __init__(self, fsock, chunk_size):
+        self.fsock = fsock
+        self.chunk_size = chunk_size
+        self.text = ""
+        self.pos = 0
+        # Characters dropped from the start of text
+        self.offset = 0
+
+    def more(self):
+        """Reads another chunk; returns False at the end of the file"""
+        chunk = self.fsock.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.text = self.text[self.pos:] + chunk
+        self.offset += self.pos
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Skips whitespace and returns the next character, or "" at the end
+        of the file"""
+        while True:
+            self.pos = _whitespace.match(self.text, self.pos).end()
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.more():
+                return ""
+
+    def expect(self, chars):
+        """Consumes the next character, which has to be one of chars"""
+        char = self.peek()
+        if not char or not char in chars:
+            raise ValueError("Expected {0} at character {1}".format(
+                " or ".join(repr(c) for c in chars), self.offset + self.pos))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Decodes the next value"""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError as e:
+                if self.more():
+                    continue
+                raise ValueError("{0} at character {1}".format(e.msg,
+                    self.offset + e.pos)) from None
+            # A number might continue in the next chunk
+            if end < len(self.text) or not self.more():
+                self.pos = end
+                return value
+
+    def element(self):
+        """Decodes the next element of an array
+
+        Returns the value, or a Malformed entry (without index). Either
+        way, the element is consumed up to the following "," or "]"."""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+                error = None
+            except json.JSONDecodeError as e:
+                value, end, error = None, None, e.msg
+            if end is not None:
+                end = _whitespace.match(self.text, end).end()
+                if end < len(self.text) and self.text[end] in ",]":
+                    self.pos = end
+                    return value
+                if end < len(self.text):
+                    error = "Extra data"
+            # Malformed, or only partially read
+            end = _element_end(self.text, self.pos)
+            if end is None and self.more():
+                continue
+            self.pos = len(self.text) if end is None else end
+            return Malformed(None, error or "Unexpected end of file")
+
+def check_note(note):
+    """Returns why a decoded entry is not an exported note, or None"""
+    if not isinstance(note, dict):
+        return "Not an object"
+    for key in ("uuid", "body", "last_modified", "cat"):
+        if key in note and not isinstance(note[key], str):
+            return "{0} is not a string".format(key)
+    if "last_modified" in note and \
+            not _timestamp.match(note["last_modified"]):
+        return "Invalid last_modified"
+    properties = note.get("properties", {})
+    if not isinstance(properties, dict):
+        return "properties is not an object"
+    for key in ("position", "size"):
+        value = properties.get(key)
+        if value is not None and not (isinstance(value, list) and
+                len(value) == 2 and all(isinstance(v, (int, float))
+                    for v in value)):
+            return "Invalid {0}".format(key)
+    return None
+
+def parse_export(fsock, chunk_size=CHUNK_SIZE):
+    """Parses an exported JSON file incrementally
+
+    Yields ("notes", note) for each entry of the notes array as soon as it
+    has been read, where note is either a dictionary or a Malformed entry,
+    and (key, value) for every other member (e.g. categories). Only one
+    entry is held in memory at a time. Raises ValueError if the file is not
+    an export at all."""
+    reader = _Reader(fsock, chunk_size)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        key = reader.value()
+        if not isinstance(key, str):
+            raise ValueError("Expected a member name at character {0}"\
+                    .format(reader.offset + reader.pos))
+        reader.expect(":")
+        if key == "notes":
+            if reader.peek() != "[":
+                raise ValueError("notes is not an array")
+            reader.expect("[")
+            index = 0
+            if reader.peek() == "]":
+                reader.expect("]")
+            else:
+                while True:
+                    note = reader.element()
+                    if isinstance(note, Malformed):
+                        note = note._replace(index=index)
+                    else:
+                        error = check_note(note)
+                        if error:
+                            note = Malformed(index, error)
+                    yield key, note
+                    index += 1
+                    if reader.expect(",]") == "]":
+                        break
+        else:
+            yield key, reader.value()
+        if reader.expect(",}") == "}":
+            return
+
+def export_files(paths):
+    """Returns the files named by paths, with directories replaced by the
+    .json files in them"""
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            files.extend(os.path.join(dirpath, filename) for filename in
+                    sorted(filenames) if filename.endswith(".json"))
+    return files
+
+def _keep_newest(notes, key, note):
+    old = notes.get(key)
+    if old is None or note.get("last_modified", "") > \
+            old.get("last_modified", ""):
+        notes[key] = note
+
+def read_export(path):
+    """Reads a whole export, keeping only the newest copy of each note
+
+    Returns a BulkImport of the file. Errors are reported in its malformed
+    entries, prefixed by the file name, rather than raised."""
+    notes = {}
+    categories = {}
+    malformed = []
+    read = 0
+    name = os.path.basename(path)
+    try:
+        with open(path, encoding="utf-8") as fsock:
+            for key, value in parse_export(fsock):
+                if key == "notes":
+                    read += 1
+                    if isinstance(value, Malformed):
+                        malformed.append(value._replace(error="{0}: {1}"\
+                                .format(name, value.error)))
+                    else:
+                        _keep_newest(notes, value.get("uuid") or
+                                (path, read), value)
+                elif key == "categories" and isinstance(value, dict):
+                    categories.update(value)
+    except (OSError, ValueError) as e:
+        malformed.append(Malformed(None, "{0}: {1}".format(name, e)))
+    return BulkImport(notes, categories, malformed, read, 1)
+
+def read_exports(paths, task=None, workers=None):
+    """Reads many exports (or directories of them) in parallel processes
+
+    Returns a BulkImport of all of them, keeping the newest copy of notes
+    found in several files; categories in later files take precedence.
+    Progress is reported to a BackgroundTask, if given, which can also
+    cancel reading."""
+    files = export_files(paths)
+    notes = {}
+    categories = {}
+    malformed = []
+    read = 0
+    # Forking the running GUI could deadlock the workers on locks held by
+    # its other threads, so they are forked from a server process which
+    # has only loaded this module
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload([__name__])
+    with ProcessPoolExecutor(workers, mp_context=context) as pool:
+        futures = [pool.submit(read_export, path) for path in files]
+        try:
+            for i, future in enumerate(futures):
+                result = future.result()
+                for key, note in result.notes.items():
+                    _keep_newest(notes, key, note)
+                categories.update(result.categories)
+                malformed.extend(result.malformed)
+                read += result.read
+                if task:
+                    task.progress(i + 1, len(files))
+        except BaseException:
+            pool.shutdown(cancel_futures=True)
+            raise
+    return BulkImport(notes, categories, malformed, read, len(files))
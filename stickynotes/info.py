@@ -2,6 +2,11 @@ PO_DIR = 'po'
 MO_DIR = 'locale'
 LOCALE_DOMAIN = "indicator-stickynotes"
 
+# Compiled bundle of the UI files, stylesheets and button icons (built by
+# setup.py) and the path under which its files are registered
+RESOURCE_FILE = "stickynotes.gresource"
+RESOURCE_PREFIX = "/org/indicator-stickynotes/"
+
 SETTINGS_FILE = "~/.config/indicator-stickynotes"
 DEBUG_SETTINGS_FILE = "~/.stickynotes"
 
@@ -9,3 +14,27 @@ FALLBACK_PROPERTIES = { "bgcolor_hsv": [48./360, 1, 1],
                         "textcolor": [32./255, 32./255, 32./255],
                         "font": "",
                         "shadow": 60}
+
+# How the data file is kept on disk: "json" rewrites a single file on every
+# save, "journal" appends changes to SETTINGS_FILE + ".journal", "sqlite"
+# keeps one row per note in SETTINGS_FILE + ".sqlite" and "shards" keeps one
+# file per note in the directory SETTINGS_FILE + ".d"
+STORAGE_BACKEND = "journal"
+# Number of journal records (or notes, if greater) that triggers compaction
+JOURNAL_COMPACT_THRESHOLD = 500
+# Number of note windows created per idle callback at startup
+STARTUP_BATCH = 10
+# Number of notes added to the search index per idle callback at startup
+INDEX_BATCH = 200
+# Number of imported notes merged per main loop callback
+IMPORT_BATCH = 200
+# Whether showing a note destroys and rebuilds its window, which works around
+# notes not reappearing after "show desktop" in Unity (lp:1105948). None
+# means only when running under Unity.
+REBUILD_ON_SHOW = None
+# Number of parsed note windows kept ready when windows are rebuilt
+WINDOW_POOL_SIZE = 4
+# Milliseconds during which save requests are coalesced into a single save
+SAVE_DELAY = 1000
+# Seconds between checks for whether the journal should be compacted
+COMPACT_INTERVAL = 60
@@ -0,0 +1,141 @@
+# Copyright © 2012-2018 Umang Varma <umang.me@gmail.com>
+#
+# This file is part of indicator-stickynotes.
+#
+# indicator-stickynotes is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# indicator-stickynotes is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# indicator-stickynotes.  If not, see <http://www.gnu.org/licenses/>.
+
+from bisect import bisect_left, insort
+from itertools import islice
+import re
+
+_word = re.compile(r"\w+")
+
+def words(text):
+    """Returns the set of lowercase words in a text"""
+    return set(_word.findall(text.casefold()))
+
+class SearchIndex:
+    """Inverted index from the words of note bodies to the notes
+
+    Notes whose body changed are merely marked stale and reindexed on the
+    next query (or a little at a time by refresh). Building the index loads
+    the body of every note, so it only happens once build is called or the
+    index is first queried."""
+    def __init__(self, noteset):
+        self.noteset = noteset
+        self.built = False
+        # Word -> notes whose body contains it
+        self._postings = {}
+        # Note -> words it is indexed under
+        self._words = {}
+        # Notes to reindex before the next query (as keys of a dict)
+        self._stale = {}
+        # Sorted words for prefix queries, created by the first one
+        self._vocabulary = None
+
+    def clear(self):
+        """Forgets everything, e.g. when other notes have been loaded"""
+        self.__init__(self.noteset)
+
+    def build(self):
+        """Marks every note of the note set as needing to be indexed"""
+        self.clear()
+        self.built = True
+        self._stale = dict.fromkeys(self.noteset.notes)
+
+    def add(self, note):
+        """Marks a new or changed note as needing to be (re)indexed"""
+        if self.built:
+            self._stale[note] = None
+
+    def remove(self, note):
+        """Drops a note from the index"""
+        if self.built:
+            self._stale.pop(note, None)
+            self._index(note, set())
+
+    def _index(self, note, newwords):
+        oldwords = self._words.pop(note, set())
+        for word in oldwords - newwords:
+            notes = self._postings[word]
+            notes.discard(note)
+            if not notes:
+                del self._postings[word]
+                if self._vocabulary is not None:
+                    del self._vocabulary[bisect_left(self._vocabulary, word)]
+        for word in newwords - oldwords:
+            if not word in self._postings:
+                self._postings[word] = set()
+                if self._vocabulary is not None:
+                    insort(self._vocabulary, word)
+            self._postings[word].add(note)
+        if newwords:
+            self._words[note] = newwords
+
+    def refresh(self, limit=None):
+        """Reindexes the notes which changed since the last query, or only
+        up to limit of them; returns whether any are left"""
+        if not self.built:
+            self.build()
+        for note in list(islice(self._stale, limit)):
+            # The window holds the current text of notes being edited
+            if note.gui != None:
+                note.gui.update_note()
+            del self._stale[note]
+            self._index(note, words(note.body))
+        return bool(self._stale)
+
+    def _completions(self, prefix):
+        """Returns the indexed words that start with prefix"""
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self._postings)
+        start = bisect_left(self._vocabulary, prefix)
+        end = start
+        while end < len(self._vocabulary) and \
+                self._vocabulary[end].startswith(prefix):
+            end += 1
+        return self._vocabulary[start:end]
+
+    def search(self, query):
+        """Returns the set of notes containing every word of query
+
+        The last word may be incomplete, so it matches any word it is the
+        beginning of, unless query ends with a space."""
+        terms = _word.findall(query.casefold())
+        if not terms:
+            return set()
+        self.refresh()
+        prefix = None
+        if not query[-1:].isspace():
+            prefix = terms.pop()
+        if not terms:
+            # Only an incomplete word
+            return set().union(*(self._postings[word]
+                for word in self._completions(prefix)))
+        # Intersect starting from the rarest word
+        postings = sorted((self._postings.get(term, set()) for term in terms),
+                key=len)
+        result = set(postings[0])
+        for notes in postings[1:]:
+            result &= notes
+        if prefix is not None:
+            completions = self._completions(prefix)
+            if len(completions) < len(result):
+                result &= set().union(*(self._postings[word]
+                    for word in completions))
+            else:
+                # Checking the few remaining notes is cheaper
+                result = {note for note in result if any(word.startswith(
+                    prefix) for word in self._words[note])}
+        return result
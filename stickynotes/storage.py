@@ -0,0 +1,683 @@
+# Copyright © 2012-2018 Umang Varma <umang.me@gmail.com>
+#
+# This file is part of indicator-stickynotes.
+#
+# indicator-stickynotes is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# indicator-stickynotes is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# indicator-stickynotes.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sqlite3
+import tarfile
+import tempfile
+import threading
+import uuid
+from os.path import expanduser
+from shutil import copyfile
+from urllib.parse import quote
+
+from stickynotes.info import JOURNAL_COMPACT_THRESHOLD
+
+# An immutable copy of what a NoteSet needs to write. notes holds (uuid,
+# serialized note) pairs for every note, or is None for incremental storages.
+# changed holds the pairs for the notes changed since the last save and
+# deleted the uuids removed since then.
+Snapshot = namedtuple("Snapshot",
+        ["notes", "changed", "deleted", "properties", "categories"])
+
+def merge_snapshots(old, new):
+    """Combines two snapshots that were not written into the later one"""
+    changed = OrderedDict(old.changed)
+    changed.update(new.changed)
+    for nuuid in new.deleted:
+        changed.pop(nuuid, None)
+    deleted = (old.deleted | new.deleted) - set(changed)
+    return new._replace(changed=tuple(changed.items()),
+            deleted=frozenset(deleted))
+
+def dumps_fragments(fragments, sproperties, scategories):
+    """Joins serialized notes, properties and categories into a document
+
+    The result is identical to json.dumps of the equivalent dictionary."""
+    return '{"notes": [' + ", ".join(fragments) + '], "properties": ' + \
+            sproperties + ', "categories": ' + scategories + '}'
+
+def atomic_write(path, data, sync=True):
+    """Replaces the contents of path with data without ever truncating it
+
+    data is a string or an iterable of strings; if iterating raises an
+    exception, path is left alone. Unless sync is False, the data is flushed
+    to disk before the rename."""
+    if isinstance(data, str):
+        data = (data,)
+    dirname = os.path.dirname(path) or "."
+    fd, tmppath = tempfile.mkstemp(dir=dirname,
+            prefix="." + os.path.basename(path) + ".")
+    try:
+        with open(fd, mode='w', encoding='utf-8') as fsock:
+            for chunk in data:
+                fsock.write(chunk)
+            if sync:
+                fsock.flush()
+                os.fsync(fsock.fileno())
+        os.replace(tmppath, path)
+    except BaseException:
+        try:
+            os.unlink(tmppath)
+        except OSError:
+            pass
+        raise
+
+class Storage:
+    """Base class for the ways a NoteSet can be kept on disk"""
+    # Whether save() can do without the list of all notes
+    incremental = False
+    # Whether load() may leave out note bodies, to be fetched by load_body()
+    lazy_bodies = False
+
+    def __init__(self, path):
+        self.path = expanduser(path)
+
+    def load(self):
+        """Returns the stored note set as a dictionary"""
+        raise NotImplementedError
+
+    def save(self, snapshot):
+        """Stores the note set described by a Snapshot"""
+        raise NotImplementedError
+
+    def load_body(self, nuuid):
+        """Returns the stored body of a note, or None if there is none"""
+        return None
+
+    def body_snapshot(self):
+        """Returns a BodySnapshot of the stored bodies, or None if load()
+        never leaves bodies out"""
+        return None
+
+    def needs_compaction(self):
+        return False
+
+    def compact(self):
+        pass
+
+    def copy_raw(self, dest):
+        """Copies the stored files as they are, even if they are corrupt"""
+        copyfile(self.path, dest)
+
+class JSONStorage(Storage):
+    """Keeps the whole note set in a single JSON file"""
+    def __init__(self, path):
+        super().__init__(path)
+        self._properties = None
+        self._categories = None
+
+    def load(self):
+        with open(self.path, encoding='utf-8') as fsock:
+            data = json.loads(fsock.read())
+        self._properties = json.dumps(data.get("properties", {}))
+        self._categories = json.dumps(data.get("categories", {}))
+        return data
+
+    def save(self, snapshot):
+        sproperties = json.dumps(snapshot.properties)
+        scategories = json.dumps(snapshot.categories)
+        if not (snapshot.changed or snapshot.deleted) and \
+                sproperties == self._properties and \
+                scategories == self._categories:
+            return
+        atomic_write(self.path, dumps_fragments(
+            [n for u, n in snapshot.notes], sproperties, scategories))
+        self._properties = sproperties
+        self._categories = scategories
+
+class JournalStorage(Storage):
+    """Keeps a JSON snapshot plus an append-only journal of changes
+
+    Saving appends one record per note that changed since the previous save,
+    so its cost does not depend on the size of the note set. compact() folds
+    the journal back into the snapshot. The snapshot has the same format as
+    the file written by JSONStorage."""
+    incremental = True
+
+    def __init__(self, path, threshold=JOURNAL_COMPACT_THRESHOLD):
+        super().__init__(path)
+        self.journal_path = self.path + ".journal"
+        self.threshold = threshold
+        # Serialized state as it currently is on disk
+        self._notes = OrderedDict()
+        self._properties = "{}"
+        self._categories = "{}"
+        self._records = 0
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as fsock:
+                data = json.loads(fsock.read())
+        except FileNotFoundError:
+            if not os.path.exists(self.journal_path):
+                raise
+            data = {}
+        notes = OrderedDict()
+        for note in data.get("notes", []):
+            note.setdefault("uuid", str(uuid.uuid4()))
+            notes[note["uuid"]] = note
+        properties = data.get("properties", {})
+        categories = data.get("categories", {})
+        self._records = 0
+        try:
+            fsock = open(self.journal_path, mode='rb')
+        except FileNotFoundError:
+            fsock = None
+        if fsock:
+            with fsock:
+                good = 0
+                for line in fsock:
+                    # A save was interrupted mid-append; everything after the
+                    # last complete record is discarded. A record is only
+                    # complete with its newline, or the next save would
+                    # append to the same line.
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        record = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        break
+                    if "note" in record:
+                        notes[record["note"]["uuid"]] = record["note"]
+                    elif "delete" in record:
+                        notes.pop(record["delete"], None)
+                    elif "properties" in record:
+                        properties = record["properties"]
+                    elif "categories" in record:
+                        categories = record["categories"]
+                    good += len(line)
+                    self._records += 1
+                if good != fsock.tell():
+                    os.truncate(self.journal_path, good)
+        self._notes = OrderedDict((u, json.dumps(n))
+                for u, n in notes.items())
+        self._properties = json.dumps(properties)
+        self._categories = json.dumps(categories)
+        return {"notes": list(notes.values()), "properties": properties,
+                "categories": categories}
+
+    def save(self, snapshot):
+        changed = [(u, n) for u, n in snapshot.changed
+                if self._notes.get(u) != n]
+        deleted = [u for u in snapshot.deleted if u in self._notes]
+        records = ['{"note": ' + n + '}' for u, n in changed]
+        records.extend(json.dumps({"delete": u}) for u in deleted)
+        sproperties = json.dumps(snapshot.properties)
+        if sproperties != self._properties:
+            records.append('{"properties": ' + sproperties + '}')
+        scategories = json.dumps(snapshot.categories)
+        if scategories != self._categories:
+            records.append('{"categories": ' + scategories + '}')
+        if not records:
+            return
+        with open(self.journal_path, mode='a', encoding='utf-8') as fsock:
+            fsock.write("\n".join(records) + "\n")
+            fsock.flush()
+            os.fsync(fsock.fileno())
+        # Only remember what was written once it is safely on disk
+        self._notes.update(changed)
+        for nuuid in deleted:
+            del self._notes[nuuid]
+        self._properties = sproperties
+        self._categories = scategories
+        self._records += len(records)
+
+    def needs_compaction(self):
+        return self._records > max(self.threshold, len(self._notes))
+
+    def copy_raw(self, dest):
+        copyfile(self.path, dest)
+        # Keep any changes that were not compacted yet
+        if os.path.exists(self.journal_path):
+            copyfile(self.journal_path, dest + ".journal")
+
+    def compact(self):
+        """Folds the journal into the snapshot"""
+        if not self._records:
+            return
+        atomic_write(self.path, dumps_fragments(self._notes.values(),
+            self._properties, self._categories))
+        # Replaying the old journal on top of the new snapshot is harmless,
+        # so a crash before this point loses nothing.
+        with open(self.journal_path, mode='w', encoding='utf-8'):
+            pass
+        self._records = 0
+
+class BodySnapshot:
+    """The note bodies stored in an SQLite database at the time it was
+    created, unaffected by later saves
+
+    It can be used from any thread, and has to be closed afterwards."""
+    def __init__(self, db_path):
+        self._conn = sqlite3.connect(db_path, isolation_level=None,
+                check_same_thread=False)
+        # In WAL mode, the first read of a transaction fixes what it sees
+        self._conn.execute("BEGIN")
+        self._conn.execute("SELECT 1 FROM notes LIMIT 1").fetchall()
+
+    def load_body(self, nuuid):
+        """Returns the stored body of a note, or None if there is none"""
+        row = self._conn.execute("SELECT body FROM notes WHERE uuid = ?",
+                (nuuid,)).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        self._conn.close()
+
+class SQLiteStorage(Storage):
+    """Keeps notes, categories and properties as rows of an SQLite database
+
+    The database lives next to the JSON data file, which is migrated into it
+    the first time it is opened. Saves only touch the rows of the notes
+    that changed. Note bodies are only read when they are first needed."""
+    incremental = True
+    lazy_bodies = True
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.db_path = self.path + ".sqlite"
+        self._conn = None
+        # Separate connection for reading bodies from the main thread
+        self._reader = None
+        self._properties = "{}"
+        self._categories = "{}"
+
+    def connect(self):
+        """Returns the connection to the database, creating it if needed"""
+        if self._conn is None:
+            # Saves happen on the SaveWorker thread, but never concurrently
+            # with anything else
+            self._conn = sqlite3.connect(self.db_path,
+                    check_same_thread=False)
+            # WAL lets bodies be read while the SaveWorker is writing
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            with self._conn:
+                self._conn.executescript("""
+                    CREATE TABLE IF NOT EXISTS notes (
+                        uuid TEXT PRIMARY KEY,
+                        seq INTEGER NOT NULL,
+                        body TEXT NOT NULL,
+                        last_modified TEXT,
+                        cat TEXT NOT NULL,
+                        properties TEXT NOT NULL);
+                    CREATE INDEX IF NOT EXISTS notes_seq ON notes (seq);
+                    CREATE TABLE IF NOT EXISTS categories (
+                        id TEXT PRIMARY KEY,
+                        data TEXT NOT NULL);
+                    CREATE TABLE IF NOT EXISTS properties (
+                        key TEXT PRIMARY KEY,
+                        value TEXT NOT NULL);""")
+        return self._conn
+
+    def load(self):
+        if not os.path.exists(self.db_path):
+            self.migrate()
+        conn = self.connect()
+        notes = [{"uuid": nuuid, "last_modified": modified, "cat": cat,
+            "properties": json.loads(properties)}
+            for nuuid, modified, cat, properties in conn.execute(
+                "SELECT uuid, last_modified, cat, properties "
+                "FROM notes ORDER BY seq")]
+        categories = {cid: json.loads(data) for cid, data in
+                conn.execute("SELECT id, data FROM categories")}
+        properties = {key: json.loads(value) for key, value in
+                conn.execute("SELECT key, value FROM properties")}
+        self._properties = json.dumps(properties)
+        self._categories = json.dumps(categories)
+        return {"notes": notes, "properties": properties,
+                "categories": categories}
+
+    def load_body(self, nuuid):
+        if self._reader is None:
+            self._reader = sqlite3.connect(self.db_path)
+        row = self._reader.execute("SELECT body FROM notes WHERE uuid = ?",
+                (nuuid,)).fetchone()
+        return row[0] if row else None
+
+    def migrate(self):
+        """Imports the JSON data file (and any journal) into the database
+
+        Raises FileNotFoundError if there is nothing to import."""
+        data = JournalStorage(self.path).load()
+        self._write([(n["uuid"], json.dumps(n)) for n in data["notes"]],
+                (), data.get("properties", {}), data.get("categories", {}))
+
+    def save(self, snapshot):
+        self._write(snapshot.changed, snapshot.deleted, snapshot.properties,
+                snapshot.categories)
+
+    def _write(self, changed, deleted, properties, categories):
+        conn = self.connect()
+        sproperties = json.dumps(properties)
+        scategories = json.dumps(categories)
+        with conn:
+            for nuuid, snote in changed:
+                note = json.loads(snote)
+                conn.execute("INSERT INTO notes (uuid, seq, body, "
+                        "last_modified, cat, properties) VALUES (?, "
+                        "(SELECT IFNULL(MAX(seq), 0) + 1 FROM notes), "
+                        "?, ?, ?, ?) ON CONFLICT (uuid) DO UPDATE SET "
+                        "body = excluded.body, "
+                        "last_modified = excluded.last_modified, "
+                        "cat = excluded.cat, "
+                        "properties = excluded.properties",
+                        (nuuid, note.get("body", ""),
+                            note.get("last_modified"), note.get("cat", ""),
+                            json.dumps(note.get("properties", {}))))
+            conn.executemany("DELETE FROM notes WHERE uuid = ?",
+                    ((nuuid,) for nuuid in deleted))
+            if sproperties != self._properties:
+                conn.execute("DELETE FROM properties")
+                conn.executemany("INSERT INTO properties (key, value) "
+                        "VALUES (?, ?)", ((key, json.dumps(value))
+                            for key, value in properties.items()))
+            if scategories != self._categories:
+                conn.execute("DELETE FROM categories")
+                conn.executemany("INSERT INTO categories (id, data) "
+                        "VALUES (?, ?)", ((cid, json.dumps(data))
+                            for cid, data in categories.items()))
+        self._properties = sproperties
+        self._categories = scategories
+
+    def body_snapshot(self):
+        self.connect()
+        return BodySnapshot(self.db_path)
+
+    def copy_raw(self, dest):
+        copyfile(self.db_path, dest)
+        # Committed transactions may still only be in the write-ahead log,
+        # which SQLite picks up next to the copy
+        if os.path.exists(self.db_path + "-wal"):
+            copyfile(self.db_path + "-wal", dest + "-wal")
+
+class ShardStorage(Storage):
+    """Keeps every note in its own file inside a data directory
+
+    Notes are stored as notes/<uuid>.json and categories and properties in
+    index.json, so a save only writes the files of the notes that changed.
+    The JSON data file is migrated into the directory the first time it is
+    opened."""
+    incremental = True
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.dir_path = self.path + ".d"
+        self.notes_path = os.path.join(self.dir_path, "notes")
+        self.index_path = os.path.join(self.dir_path, "index.json")
+        # Unknown until loaded, so the index is always written once
+        self._properties = None
+        self._categories = None
+
+    def note_path(self, nuuid):
+        return os.path.join(self.notes_path, quote(nuuid, safe="") + ".json")
+
+    def load(self):
+        if not os.path.exists(self.index_path):
+            self.migrate()
+        with open(self.index_path, encoding='utf-8') as fsock:
+            index = json.loads(fsock.read())
+        def _read(filename):
+            with open(os.path.join(self.notes_path, filename),
+                    encoding='utf-8') as fsock:
+                return json.loads(fsock.read())
+        filenames = [f for f in os.listdir(self.notes_path)
+                if f.endswith(".json")]
+        with ThreadPoolExecutor() as executor:
+            notes = list(executor.map(_read, filenames))
+        notes.sort(key=lambda n: n.get("last_modified") or "")
+        properties = index.get("properties", {})
+        categories = index.get("categories", {})
+        self._properties = json.dumps(properties)
+        self._categories = json.dumps(categories)
+        return {"notes": notes, "properties": properties,
+                "categories": categories}
+
+    def migrate(self):
+        """Splits the JSON data file (and any journal) into the directory
+
+        Raises FileNotFoundError if there is nothing to import."""
+        data = JournalStorage(self.path).load()
+        self._properties = self._categories = None
+        self._write([(n["uuid"], json.dumps(n)) for n in data["notes"]],
+                (), data.get("properties", {}), data.get("categories", {}),
+                sync=False)
+
+    def save(self, snapshot):
+        self._write(snapshot.changed, snapshot.deleted, snapshot.properties,
+                snapshot.categories)
+
+    def _write(self, changed, deleted, properties, categories, sync=True):
+        os.makedirs(self.notes_path, exist_ok=True)
+        for nuuid, snote in changed:
+            atomic_write(self.note_path(nuuid), snote, sync)
+        if not sync:
+            # Flush all the note files at once rather than one by one
+            os.sync()
+        for nuuid in deleted:
+            try:
+                os.unlink(self.note_path(nuuid))
+            except FileNotFoundError:
+                pass
+        sproperties = json.dumps(properties)
+        scategories = json.dumps(categories)
+        # The index is written last; its presence marks a complete migration
+        if sproperties != self._properties or \
+                scategories != self._categories:
+            atomic_write(self.index_path, '{"properties": ' + sproperties +
+                    ', "categories": ' + scategories + '}')
+            self._properties = sproperties
+            self._categories = scategories
+
+    def copy_raw(self, dest):
+        """Archives the data directory as a gzipped tar file at dest, which
+        is replaced if it exists"""
+        with tarfile.open(dest, "w:gz") as tar:
+            tar.add(self.dir_path, arcname=os.path.basename(self.dir_path))
+
+class SaveWorker:
+    """Writes snapshots to a storage from a background thread
+
+    Only the latest snapshot waiting to be written is kept; older ones are
+    folded into it. After every write, dispatch(done, error) is called from
+    the worker thread, error being None on success. dispatch should hand the
+    call over to the main loop (e.g. GLib.idle_add)."""
+    def __init__(self, storage, dispatch, done):
+        self.storage = storage
+        self.dispatch = dispatch
+        self.done = done
+        self._cond = threading.Condition()
+        self._pending = None
+        # A snapshot whose write failed; retried with the next one
+        self._failed = None
+        self._compact = None
+        self._busy = False
+        self._thread = threading.Thread(target=self._run,
+                name="stickynotes-save", daemon=True)
+        self._thread.start()
+
+    def submit(self, snapshot):
+        """Queues a snapshot, replacing any that is not yet being written"""
+        with self._cond:
+            if self._pending:
+                snapshot = merge_snapshots(self._pending, snapshot)
+            self._pending = snapshot
+            self._cond.notify()
+
+    def compact(self, force=False):
+        """Queues a compaction of the storage after pending writes"""
+        with self._cond:
+            self._compact = force or bool(self._compact)
+            self._cond.notify()
+
+    def wait(self):
+        """Blocks until everything queued has been written"""
+        with self._cond:
+            while self._busy or self._pending or self._compact is not None:
+                self._cond.wait()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and self._compact is None:
+                    self._cond.wait()
+                snapshot, self._pending = self._pending, None
+                compact, self._compact = self._compact, None
+                if snapshot and self._failed:
+                    snapshot = merge_snapshots(self._failed, snapshot)
+                self._busy = True
+            error = None
+            try:
+                if snapshot:
+                    try:
+                        self.storage.save(snapshot)
+                    except BaseException:
+                        with self._cond:
+                            self._failed = snapshot
+                        raise
+                    with self._cond:
+                        self._failed = None
+                if compact is not None and (compact or
+                        self.storage.needs_compaction()):
+                    self.storage.compact()
+            except Exception as e:
+                error = e
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+            if snapshot or error:
+                self.dispatch(self.done, error)
+
+# Everything needed to export a note set, taken at one point in time. notes
+# holds serialized notes, or dictionaries whose body is still to be read
+# from bodies (a BodySnapshot).
+ExportSnapshot = namedtuple("ExportSnapshot",
+        ["notes", "properties", "categories", "bodies"])
+
+def write_export(path, snapshot, task=None):
+    """Writes an ExportSnapshot to path as a JSON file, atomically
+
+    The result is the same as that of NoteSet.dumps. Progress is reported to
+    a BackgroundTask, if given, which can also cancel the export."""
+    def _chunks():
+        yield '{"notes": ['
+        total = len(snapshot.notes)
+        for i, note in enumerate(snapshot.notes):
+            if task and i % 100 == 0:
+                task.progress(i, total)
+            if not isinstance(note, str):
+                note["body"] = snapshot.bodies.load_body(note["uuid"]) or ""
+                note = json.dumps(note)
+            yield note if i == 0 else ", " + note
+        yield '], "properties": ' + snapshot.properties + \
+                ', "categories": ' + snapshot.categories + '}'
+    try:
+        atomic_write(path, _chunks())
+    finally:
+        if snapshot.bodies:
+            snapshot.bodies.close()
+
+class Cancelled(Exception):
+    """Raised in a BackgroundTask that has been cancelled"""
+
+class BackgroundTask:
+    """Runs function(task) in a worker thread
+
+    The function reports its progress with task.progress(), which raises
+    Cancelled once cancel() has been called, and can run code on the main
+    loop with task.call(). dispatch hands calls over to the main loop (e.g.
+    GLib.idle_add). progress(fraction) and, at the end, finished(result,
+    error) are called there; error is None on success."""
+    def __init__(self, function, dispatch, progress, finished):
+        self.function = function
+        self.dispatch = dispatch
+        self.on_progress = progress
+        self.on_finished = finished
+        self.cancelled = threading.Event()
+        self._lock = threading.Lock()
+        # Latest fraction done, and whether it is yet to be shown
+        self._fraction = 0.0
+        self._progress_queued = False
+        self._thread = threading.Thread(target=self._run,
+                name="stickynotes-task", daemon=True)
+        self._thread.start()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def progress(self, done, total):
+        """Records that done out of total steps are finished"""
+        if self.cancelled.is_set():
+            raise Cancelled()
+        with self._lock:
+            self._fraction = done / total if total else 0.0
+            if self._progress_queued:
+                return
+            self._progress_queued = True
+        self.dispatch(self._show_progress)
+
+    def _show_progress(self):
+        with self._lock:
+            fraction, self._progress_queued = self._fraction, False
+        self.on_progress(fraction)
+        return False
+
+    def call(self, function, *args):
+        """Runs function(*args) on the main loop, waits for it and returns
+        its result"""
+        done = threading.Event()
+        result = []
+        def _call():
+            try:
+                result.append((function(*args), None))
+            except Exception as e:
+                result.append((None, e))
+            finally:
+                done.set()
+            return False
+        self.dispatch(_call)
+        done.wait()
+        value, error = result[0]
+        if error is not None:
+            raise error
+        return value
+
+    def _run(self):
+        result, error = None, None
+        try:
+            result = self.function(self)
+        except Exception as e:
+            error = e
+        self.dispatch(self._finish, result, error)
+
+    def _finish(self, result, error):
+        self.on_finished(result, error)
+        return False
+
+STORAGE_CLASSES = {"json": JSONStorage, "journal": JournalStorage,
+        "sqlite": SQLiteStorage, "shards": ShardStorage}
+
+def open_storage(path, backend):
+    """Returns the storage of the given kind for the data file at path"""
+    try:
+        return STORAGE_CLASSES[backend](path)
+    except KeyError:
+        raise ValueError("Unknown storage backend: {0}".format(backend))
@@ -0,0 +1,211 @@
+# Copyright © 2012-2018 Umang Varma <umang.me@gmail.com>
+#
+# This file is part of indicator-stickynotes.
+#
+# indicator-stickynotes is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# indicator-stickynotes is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# indicator-stickynotes.  If not, see <http://www.gnu.org/licenses/>.
+
+# Exercises the control protocol over a real local socket, with a select()
+# loop standing in for the GLib main loop. Run with
+# "python3 -m unittest discover tests"; GTK is not needed.
+
+import argparse
+import os
+import select
+import socket
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    ".."))
+from stickynotes import control
+
+class Loop:
+    """Runs the callbacks given to watch() on a thread, like io_add_watch
+    on the main loop"""
+    def __init__(self):
+        self.watches = {}
+        # Functions to call on the loop, e.g. deferred replies
+        self.pending = []
+        self.lock = threading.Lock()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def watch(self, fd, callback):
+        with self.lock:
+            self.watches[fd] = callback
+
+    def call_soon(self, function):
+        with self.lock:
+            self.pending.append(function)
+
+    def run(self):
+        while self.running:
+            with self.lock:
+                pending, self.pending = self.pending, []
+                fds = list(self.watches)
+            for function in pending:
+                function()
+            readable, writable, failed = select.select(fds, [], [], 0.01)
+            for fd in readable:
+                if not self.watches[fd]():
+                    with self.lock:
+                        del self.watches[fd]
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+class ControlTest(unittest.TestCase):
+    def setUp(self):
+        self.address = "\0indicator-stickynotes-test-{0}-{1}".format(
+                os.getpid(), id(self))
+        self.requests = []
+        self.loop = Loop()
+        self.server = control.ControlServer(self.handle, self.loop.watch,
+                self.address)
+        self.loop.thread.start()
+
+    def tearDown(self):
+        self.loop.stop()
+        self.server.close()
+
+    def handle(self, request, reply):
+        self.requests.append(request)
+        command = request["command"]
+        if command == "search":
+            reply({"ok": True, "notes": [{"uuid": "a", "body": "found"}]})
+        elif command == "later":
+            # Replies from a later iteration of the loop, like exports
+            self.loop.call_soon(lambda: reply({"ok": True}))
+        elif command == "new-note":
+            reply({"ok": True})
+        else:
+            reply({"ok": False, "error": "Unknown command"})
+
+    def send_raw(self, data):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.address)
+            sock.sendall(data)
+            sock.shutdown(socket.SHUT_WR)
+            return sock.makefile("rb").read()
+
+    def test_probe(self):
+        self.assertEqual(control.send_request(None, self.address), {})
+        self.assertEqual(self.requests, [])
+
+    def test_no_instance(self):
+        self.assertIsNone(control.send_request({"command": "show-all"},
+            self.address + "-missing"))
+
+    def test_request(self):
+        body = "x" * 300000 + "\né"
+        response = control.send_request({"command": "new-note",
+            "body": body}, self.address)
+        self.assertEqual(response, {"ok": True})
+        self.assertEqual(self.requests, [{"command": "new-note",
+            "body": body}])
+
+    def test_search(self):
+        response = control.send_request({"command": "search",
+            "query": "fo"}, self.address)
+        self.assertEqual(response["notes"], [{"uuid": "a", "body": "found"}])
+
+    def test_error(self):
+        response = control.send_request({"command": "frobnicate"},
+                self.address)
+        self.assertEqual(response, {"ok": False, "error": "Unknown command"})
+
+    def test_deferred_reply(self):
+        self.assertEqual(control.send_request({"command": "later"},
+            self.address), {"ok": True})
+
+    def test_malformed(self):
+        for data in (b"[1]\n", b"{\"command\"", b"\xff\n"):
+            self.assertIn(b"Malformed request", self.send_raw(data))
+        self.assertEqual(self.requests, [])
+
+    def test_many_clients(self):
+        for i in range(50):
+            control.send_request({"command": "new-note", "body": str(i)},
+                    self.address)
+        self.assertEqual([r["body"] for r in self.requests],
+                [str(i) for i in range(50)])
+        # Only the listening socket is left being watched, once the loop
+        # has dropped the last connection
+        deadline = time.monotonic() + 1
+        while len(self.loop.watches) > 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(list(self.loop.watches), [self.server.sock.fileno()])
+
+    def test_server_of_other_user(self):
+        with mock.patch("os.getuid", return_value=os.getuid() + 1):
+            self.assertIsNone(control.send_request({"command": "search",
+                "query": "secret"}, self.address))
+        self.assertEqual(self.requests, [])
+
+    @unittest.skipUnless(os.getuid() == 0, "needs root to switch users")
+    def test_client_of_other_user(self):
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # Connect as nobody and report what the server answered
+            answer = b""
+            try:
+                os.setuid(65534)
+                with socket.socket(socket.AF_UNIX,
+                        socket.SOCK_STREAM) as sock:
+                    sock.connect(self.address)
+                    sock.sendall(b'{"command": "search", "query": ""}\n')
+                    answer = sock.recv(65536)
+            except OSError as e:
+                # The server may close the connection before the request
+                # has been sent
+                answer = type(e).__name__.encode()
+            finally:
+                os.write(write_end, answer)
+                os._exit(0)
+        os.close(write_end)
+        with os.fdopen(read_end, "rb") as pipe:
+            answer = pipe.read()
+        os.waitpid(pid, 0)
+        self.assertIn(answer, (b"", b"BrokenPipeError",
+            b"ConnectionResetError"))
+        self.assertEqual(self.requests, [])
+
+class ArgumentsTest(unittest.TestCase):
+    def parse(self, *argv):
+        parser = argparse.ArgumentParser()
+        control.add_arguments(parser)
+        return control.request_from_args(parser.parse_args(argv))
+
+    def test_requests(self):
+        self.assertIsNone(self.parse())
+        self.assertEqual(self.parse("--new-note"),
+                {"command": "new-note", "body": ""})
+        self.assertEqual(self.parse("--new-note", "Buy milk"),
+                {"command": "new-note", "body": "Buy milk"})
+        self.assertEqual(self.parse("--hide-all"), {"command": "hide-all"})
+        self.assertEqual(self.parse("--search", "a b"),
+                {"command": "search", "query": "a b"})
+        self.assertEqual(self.parse("--export", "out.json"),
+                {"command": "export", "path": os.path.abspath("out.json")})
+        self.assertEqual(self.parse("--import", "a", "b"),
+                {"command": "import", "paths": [os.path.abspath("a"),
+                    os.path.abspath("b")]})
+
+if __name__ == "__main__":
+    unittest.main()
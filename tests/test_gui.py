@@ -0,0 +1,92 @@
+# Copyright © 2012-2018 Umang Varma <umang.me@gmail.com>
+#
+# This file is part of indicator-stickynotes.
+#
+# indicator-stickynotes is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# indicator-stickynotes is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# indicator-stickynotes.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks that restyling note windows does not pile up style providers. Needs
+# PyGObject and a display, and is skipped without them. Run with
+# "python3 -m unittest discover tests".
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    ".."))
+try:
+    import gi
+    gi.require_version("Gtk", "3.0")
+    from gi.repository import Gtk
+    have_display = Gtk.init_check(sys.argv)[0]
+except (ImportError, ValueError):
+    have_display = False
+if have_display:
+    from stickynotes import gui
+    from stickynotes.backend import NoteSet
+
+class Indicator:
+    """Stands in for IndicatorStickyNotes, which windows only call back"""
+    def show_settings(self, *args):
+        pass
+
+@unittest.skipUnless(have_display, "needs GTK and a display")
+class StyleProviderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.nset = NoteSet(gui.StickyNote, os.path.join(self.directory.name,
+            "notes"), Indicator())
+        self.nset.loads('{"categories": {"a": {"name": "A"}, '
+                '"b": {"name": "B"}}}')
+        self.notes = [self.nset.new() for i in range(3)]
+
+    def tearDown(self):
+        for note in self.notes:
+            note.gui.destroy_window()
+        self.directory.cleanup()
+
+    def test_global_css(self):
+        gui.load_global_css()
+        counts = gui.count_style_providers()
+        for i in range(5):
+            gui.load_global_css()
+        self.assertEqual(gui.count_style_providers(), counts)
+
+    def test_update_style(self):
+        counts = gui.count_style_providers()
+        for i in range(5):
+            for note in self.notes:
+                note.gui.update_style()
+        self.assertEqual(gui.count_style_providers(), counts)
+
+    def test_change_category(self):
+        before = gui.count_style_providers()
+        note = self.notes[0]
+        for cat in ["a", "b", "a", "b"]:
+            note.gui.set_category(None, cat)
+        counts = gui.count_style_providers()
+        self.assertEqual(counts["attached"], before["attached"])
+        self.assertLessEqual(counts["category"], before["category"] + 2)
+
+    def test_rebuild(self):
+        counts = gui.count_style_providers()
+        note = self.notes[0]
+        for i in range(3):
+            note.gui.destroy_window()
+            note.gui.build_note()
+        self.assertEqual(gui.count_style_providers(), counts)
+
+if __name__ == "__main__":
+    unittest.main()
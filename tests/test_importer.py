@@ -0,0 +1,188 @@
+# Copyright © 2012-2018 Umang Varma <umang.me@gmail.com>
+#
+# This file is part of indicator-stickynotes.
+#
+# indicator-stickynotes is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# indicator-stickynotes is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# indicator-stickynotes.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks the incremental parser of exports against json.loads, with chunks
+# small enough that every value is split across them. Run with
+# "python3 -m unittest discover tests".
+
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    ".."))
+from stickynotes.importer import Malformed, parse_export, read_export, \
+        read_exports
+
+def parse(text, chunk_size):
+    """Returns the (key, value) pairs parse_export yields for text and the
+    ValueError it raises in the end, if any"""
+    items = []
+    try:
+        for item in parse_export(io.StringIO(text), chunk_size):
+            items.append(item)
+    except ValueError as e:
+        return items, e
+    return items, None
+
+def random_text(rng):
+    """Returns text full of the characters the parser has to look out for"""
+    return "".join(rng.choice('ab ,:[]{}"\\\n\té\U0001f600')
+            for i in range(rng.randint(0, 12)))
+
+def random_note(rng, i):
+    note = {"uuid": "note-{0}".format(i), "body": random_text(rng),
+            "last_modified": "2018-01-{0:02}T12:00:00".format(
+                rng.randint(1, 28)),
+            "cat": rng.choice(["", "cat-a", "cat-b"])}
+    if rng.random() < 0.7:
+        note["properties"] = {"position": [rng.randint(-10, 2000),
+            rng.randint(0, 1000)], "size": [200, 150.5],
+            "locked": rng.random() < 0.5}
+    return note
+
+def random_export(rng):
+    data = {"notes": [random_note(rng, i) for i in
+        range(rng.randint(0, 6))],
+        "properties": {"all_visible": True, "nested": [[], {}, None]},
+        "categories": {"cat-a": {"name": random_text(rng),
+            "bgcolor_hsv": [0.1, 0.5, 1e-3]}}}
+    if rng.random() < 0.5:
+        del data["properties"]
+    text = json.dumps(data, ensure_ascii=rng.random() < 0.5,
+            indent=rng.choice([None, 0, 2]))
+    return data, text
+
+class ParseExportTest(unittest.TestCase):
+    def test_matches_json(self):
+        rng = random.Random(1)
+        for i in range(1000):
+            data, text = random_export(rng)
+            chunk_size = rng.randint(1, 20)
+            items, error = parse(text, chunk_size)
+            self.assertIsNone(error, text)
+            self.assertEqual([v for k, v in items if k == "notes"],
+                    data["notes"], text)
+            self.assertEqual({k: v for k, v in items if k != "notes"},
+                    {k: v for k, v in data.items() if k != "notes"}, text)
+
+    def test_empty(self):
+        for text in ("{}", " { } ", '{"notes": []}', '{"notes":[ ]}'):
+            for chunk_size in (1, 2, 100):
+                self.assertEqual(parse(text, chunk_size), ([], None))
+
+    def test_malformed_elements(self):
+        text = ('{"notes": [{"uuid": "a"}, {"uuid": nope}, [1, "]"], 5, '
+                '{"uuid": "b" "c"}, {"uuid": 3}, {"last_modified": '
+                '"yesterday"}, {"properties": {"size": [1]}}, "}, {", '
+                '{"uuid": "d"}], "categories": {"x": {}}}')
+        expected = [{"uuid": "a"}, Malformed(1, "Expecting value"),
+                Malformed(2, "Not an object"), Malformed(3, "Not an object"),
+                Malformed(4, "Expecting ',' delimiter"),
+                Malformed(5, "uuid is not a string"),
+                Malformed(6, "Invalid last_modified"),
+                Malformed(7, "Invalid size"), Malformed(8, "Not an object"),
+                {"uuid": "d"}]
+        for chunk_size in range(1, 21):
+            items, error = parse(text, chunk_size)
+            self.assertIsNone(error)
+            self.assertEqual(items, [("notes", note) for note in expected] +
+                    [("categories", {"x": {}})])
+
+    def test_truncated(self):
+        rng = random.Random(2)
+        for i in range(300):
+            data, text = random_export(rng)
+            cut = rng.randrange(len(text))
+            items, error = parse(text[:cut], rng.randint(1, 20))
+            self.assertIsInstance(error, ValueError, text[:cut])
+            # Whatever was yielded is what the complete file starts with,
+            # apart from the entry cut off, which is reported as malformed
+            notes = [v for k, v in items if k == "notes"]
+            for index, note in enumerate(notes):
+                if isinstance(note, Malformed):
+                    self.assertEqual(note.index, index)
+                    self.assertEqual(index, len(notes) - 1)
+                else:
+                    self.assertEqual(note, data["notes"][index])
+
+    def test_truncated_entry(self):
+        text = '{"notes": [{"uuid": "a"}, {"uuid": "b", "bo'
+        for chunk_size in (1, 3, 100):
+            items, error = parse(text, chunk_size)
+            self.assertEqual(items[0], ("notes", {"uuid": "a"}))
+            self.assertEqual(len(items), 2)
+            self.assertIsInstance(items[1][1], Malformed)
+            self.assertEqual(items[1][1].index, 1)
+            self.assertIsInstance(error, ValueError)
+
+    def test_not_an_export(self):
+        for text in ("", "garbage", "[1, 2]", '"notes"', "{1: 2}",
+                '{"notes": 5}', '{"notes": {}}', '{"notes" []}',
+                '{"notes": [] "categories": {}}'):
+            for chunk_size in (1, 2, 100):
+                items, error = parse(text, chunk_size)
+                self.assertEqual(items, [], text)
+                self.assertIsInstance(error, ValueError, text)
+
+class ReadExportsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.directory.name, name)
+        with open(path, "w", encoding="utf-8") as fsock:
+            fsock.write(text)
+        return path
+
+    def test_read_export(self):
+        path = self.write("a.json", '{"notes": [{"uuid": "a", '
+                '"last_modified": "2018-01-01T00:00:00"}, {"uuid": "a", '
+                '"last_modified": "2018-01-02T00:00:00"}, 5], '
+                '"categories": {"c": {}}}')
+        bulk = read_export(path)
+        self.assertEqual(bulk.notes, {"a": {"uuid": "a",
+            "last_modified": "2018-01-02T00:00:00"}})
+        self.assertEqual(bulk.categories, {"c": {}})
+        self.assertEqual(bulk.malformed, [Malformed(2,
+            "a.json: Not an object")])
+        self.assertEqual(bulk.read, 3)
+
+    def test_read_exports(self):
+        self.write("a.json", '{"notes": [{"uuid": "a", "body": "old", '
+                '"last_modified": "2018-01-01T00:00:00"}]}')
+        self.write("b.json", '{"notes": [{"uuid": "a", "body": "new", '
+                '"last_modified": "2018-01-02T00:00:00"}, {"body": "x"}]}')
+        self.write("c.json", "garbage")
+        self.write("ignored.txt", "garbage")
+        bulk = read_exports([self.directory.name], workers=2)
+        self.assertEqual(bulk.notes["a"]["body"], "new")
+        self.assertEqual(len(bulk.notes), 2)
+        self.assertEqual(bulk.read, 3)
+        self.assertEqual(bulk.files, 3)
+        self.assertEqual(bulk.malformed, [Malformed(None,
+            "c.json: Expected '{' at character 0")])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,188 @@
+# Copyright © 2012-2018 Umang Varma <umang.me@gmail.com>
+#
+# This file is part of indicator-stickynotes.
+#
+# indicator-stickynotes is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# indicator-stickynotes is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# indicator-stickynotes.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks how imported notes are merged into a note set, using the dummy GUI.
+# Run with "python3 -m unittest discover tests".
+
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    ".."))
+from stickynotes.backend import NoteSet, Merge, Malformed, dGUI
+
+OLD = "2018-01-01T00:00:00"
+NOW = "2018-01-02T00:00:00"
+NEW = "2018-01-03T00:00:00"
+
+class EditedGUI(dGUI):
+    """A window holding an edit that has not been saved yet"""
+    def __init__(self, note):
+        self.note = note
+        self.shown = 0
+        self.restyled = 0
+    def show(self, *args, **kwargs):
+        self.shown += 1
+    def update_note(self):
+        self.note.update("edited")
+    def properties(self):
+        return self.note.properties
+    def update_style(self):
+        self.restyled += 1
+
+def note(nuuid, body="", last_modified=NOW, cat="", **properties):
+    return {"uuid": nuuid, "body": body, "last_modified": last_modified,
+            "cat": cat, "properties": properties}
+
+def export(*notes, categories=None):
+    data = {"notes": list(notes)}
+    if categories is not None:
+        data["categories"] = categories
+    return json.dumps(data)
+
+class MergeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.nset = NoteSet(dGUI, os.path.join(self.directory.name, "notes"),
+                None, backend="json")
+        self.nset.load_data({"notes": [note("a", "local a", position=[1, 2]),
+            note("b", "local b", cat="c1")],
+            "categories": {"c1": {"name": "One"}}})
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_added(self):
+        report = self.nset.merge(export(note("new", "hello")))
+        self.assertEqual(report.added, ["new"])
+        added = self.nset.find("new")
+        self.assertEqual(added.body, "hello")
+        self.assertIsNotNone(added.gui)
+        self.assertEqual(self.nset.search("hello"), [added])
+
+    def test_added_without_uuid(self):
+        report = self.nset.merge(export({"body": "anonymous"}))
+        self.assertEqual(len(report.added), 1)
+        self.assertEqual(self.nset.find(report.added[0]).body, "anonymous")
+
+    def test_updated(self):
+        report = self.nset.merge(export(note("a", "remote a", NEW, "c1",
+            position=[5, 6])))
+        self.assertEqual(report.updated, ["a"])
+        a = self.nset.find("a")
+        self.assertEqual((a.body, a.category, a.position, a.last_modified_str),
+                ("remote a", "c1", (5, 6), NEW))
+        self.assertEqual(self.nset.category_notes("c1"),
+                [self.nset.find("b"), a])
+
+    def test_unchanged(self):
+        report = self.nset.merge(export(note("a", "local a", position=[1, 2]),
+            note("b", "local b", cat="c1")))
+        self.assertEqual(report.unchanged, ["a", "b"])
+        self.assertEqual(report.updated + report.added + report.conflicts, [])
+
+    def test_older(self):
+        report = self.nset.merge(export(note("a", "remote a", OLD)))
+        self.assertEqual(report.conflicts, ["a"])
+        self.assertEqual(self.nset.find("a").body, "local a")
+
+    def test_equal_timestamps(self):
+        # Without a newer timestamp, differences cannot be resolved
+        report = self.nset.merge(export(note("a", "local a", cat="c1",
+            position=[1, 2]), note("b", "local b", cat="c1",
+                position=[3, 4])))
+        self.assertEqual(report.conflicts, ["a", "b"])
+        self.assertEqual(self.nset.find("a").category, "")
+        self.assertIsNone(self.nset.find("b").position)
+
+    def test_unsaved_edit(self):
+        a = self.nset.find("a")
+        a.gui = EditedGUI(a)
+        a.mark_dirty()
+        report = self.nset.merge(export(note("a", "remote a", NEW)))
+        # The edit in the window is more recent than the import
+        self.assertEqual(report.conflicts, ["a"])
+        self.assertEqual(a.body, "edited")
+
+    def test_categories_after_notes(self):
+        report = self.nset.merge(export(note("new", cat="c2"),
+            note("a", "remote a", NEW, cat="c2"),
+            categories={"c2": {"name": "Two"}}))
+        self.assertEqual(report.added, ["new"])
+        self.assertEqual(report.updated, ["a"])
+        self.assertEqual(self.nset.find("new").category, "c2")
+        self.assertEqual(self.nset.find("a").category, "c2")
+        self.assertEqual(self.nset.categories["c2"], {"name": "Two"})
+        self.assertEqual(set(self.nset.category_notes("c2")),
+                {self.nset.find("new"), self.nset.find("a")})
+
+    def test_missing_category(self):
+        self.nset.merge(export(note("new", cat="c2")))
+        self.assertEqual(self.nset.find("new").category, "")
+
+    def test_restyled(self):
+        b = self.nset.find("b")
+        b.gui = EditedGUI(b)
+        self.nset.merge(export(categories={"c1": {"name": "Renamed"}}))
+        self.assertEqual(b.gui.restyled, 1)
+        # Restyling leaves the window and its unsaved text alone
+        self.assertEqual(b.gui.shown, 0)
+        self.assertEqual(b.body, "local b")
+
+    def test_malformed(self):
+        report = self.nset.merge('{"notes": [{"uuid": 5}, '
+                '{"uuid": "new"}, {"uuid": "x"')
+        self.assertEqual(report.added, ["new"])
+        self.assertEqual([m.index for m in report.malformed], [0, 2, None])
+
+    def test_not_an_export(self):
+        with self.assertRaises(ValueError):
+            self.nset.merge("[]")
+
+    def test_deleted_during_merge(self):
+        merge = Merge(self.nset)
+        merge.feed("notes", note("a", "remote a", NEW, cat="c2"))
+        merge.feed("notes", note("new", cat="c2"))
+        a, added = self.nset.find("a"), self.nset.find("new")
+        a.delete()
+        added.delete()
+        merge.feed("categories", {"c2": {"name": "Two"}})
+        report = merge.finish()
+        self.assertEqual(report.updated, ["a"])
+        self.assertEqual(report.added, ["new"])
+        self.assertIsNone(self.nset.find("a"))
+        self.assertIsNone(self.nset.find("new"))
+        self.assertNotIn(a, self.nset.notes)
+        self.assertEqual(self.nset.category_notes("c2"), [])
+        # Neither is shown again or saved
+        self.assertIsNone(a.gui)
+        self.assertIsNone(added.gui)
+        self.assertNotIn('"new"', self.nset.dumps())
+
+    def test_deleted_then_merged_again(self):
+        merge = Merge(self.nset)
+        self.nset.find("a").delete()
+        merge.feed("notes", note("a", "remote a", OLD))
+        report = merge.finish()
+        self.assertEqual(report.added, ["a"])
+        self.assertEqual(self.nset.find("a").body, "remote a")
+
+if __name__ == "__main__":
+    unittest.main()
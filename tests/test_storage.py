@@ -0,0 +1,121 @@
+# Copyright © 2012-2018 Umang Varma <umang.me@gmail.com>
+#
+# This file is part of indicator-stickynotes.
+#
+# indicator-stickynotes is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# indicator-stickynotes is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# indicator-stickynotes.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks how the storages recover from interrupted saves. Run with
+# "python3 -m unittest discover tests".
+
+import json
+import os
+import sqlite3
+import sys
+import tarfile
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    ".."))
+from stickynotes import storage
+
+def snapshot(*bodies):
+    """Returns a Snapshot in which the notes of the given bodies changed"""
+    return storage.Snapshot(notes=None, changed=tuple((body,
+        json.dumps({"uuid": body, "body": body})) for body in bodies),
+        deleted=frozenset(), properties={}, categories={})
+
+class JournalStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "notes")
+        with open(self.path, "w", encoding="utf-8") as fsock:
+            fsock.write("{}")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def reopen(self):
+        journal = storage.JournalStorage(self.path)
+        return journal, [note["body"] for note in journal.load()["notes"]]
+
+    def cut_journal(self, size):
+        """Drops the last size bytes of the journal, like a crash would"""
+        journal_path = self.path + ".journal"
+        os.truncate(journal_path, os.path.getsize(journal_path) - size)
+
+    def test_saves(self):
+        journal, bodies = self.reopen()
+        journal.save(snapshot("one"))
+        journal.save(snapshot("two"))
+        self.assertEqual(self.reopen()[1], ["one", "two"])
+
+    def test_missing_newline(self):
+        journal, bodies = self.reopen()
+        journal.save(snapshot("one"))
+        journal.save(snapshot("two"))
+        self.cut_journal(1)
+        journal, bodies = self.reopen()
+        self.assertEqual(bodies, ["one"])
+        journal.save(snapshot("three"))
+        self.assertEqual(self.reopen()[1], ["one", "three"])
+
+    def test_cut_mid_record(self):
+        journal, bodies = self.reopen()
+        journal.save(snapshot("one"))
+        journal.save(snapshot("two"))
+        self.cut_journal(10)
+        journal, bodies = self.reopen()
+        self.assertEqual(bodies, ["one"])
+        journal.save(snapshot("three"))
+        journal.save(snapshot("four"))
+        self.assertEqual(self.reopen()[1], ["one", "three", "four"])
+
+class CopyRawTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "notes")
+        self.dest = os.path.join(self.directory.name, "backup")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_shards(self):
+        shards = storage.ShardStorage(self.path)
+        shards.save(snapshot("one", "two"))
+        # The file chooser lets users pick a file to overwrite
+        with open(self.dest, "w") as fsock:
+            fsock.write("old backup")
+        shards.copy_raw(self.dest)
+        with tarfile.open(self.dest) as tar:
+            self.assertEqual(sorted(tar.getnames()), ["notes.d",
+                "notes.d/index.json", "notes.d/notes",
+                "notes.d/notes/one.json", "notes.d/notes/two.json"])
+
+    def test_sqlite(self):
+        db = storage.SQLiteStorage(self.path)
+        with open(self.path, "w", encoding="utf-8") as fsock:
+            fsock.write("{}")
+        db.load()
+        db.save(snapshot("one", "two"))
+        # The connection stays open, so the saves are still in the log
+        self.assertTrue(os.path.getsize(db.db_path + "-wal"))
+        db.copy_raw(self.dest)
+        conn = sqlite3.connect(self.dest)
+        self.assertEqual(conn.execute("SELECT body FROM notes ORDER BY seq")\
+                .fetchall(), [("one",), ("two",)])
+        conn.close()
+
+if __name__ == "__main__":
+    unittest.main()